@@ -584,6 +584,7 @@ class Vocab:
         self._token_freqs = sorted(counter.items(), key=lambda x: x[1],
                                    reverse=True)
         # 未知词元的索引为0
+        self.reserved_tokens = reserved_tokens
         self.idx_to_token = ['<unk>'] + reserved_tokens
         self.token_to_idx = {token: idx
                              for idx, token in enumerate(self.idx_to_token)}
@@ -2332,7 +2333,7 @@ d2l.DATA_HUB['wikitext-2'] = (
     'https://s3.amazonaws.com/research.metamind.io/wikitext/'
     'wikitext-2-v1.zip', '3c914d17d80b1459be871a5039ac23e752a53cbe')
 
-def _read_wiki(data_dir):
+def _read_wiki(data_dir, rng=random):
     """Defined in :numref:`sec_bert-dataset`"""
     file_name = os.path.join(data_dir, 'wiki.train.tokens')
     with open(file_name, 'r') as f:
@@ -2340,7 +2341,7 @@ def _read_wiki(data_dir):
     # 大写字母转换为小写字母
     paragraphs = [line.strip().lower().split(' . ')
                   for line in lines if len(line.split(' . ')) >= 2]
-    random.shuffle(paragraphs)
+    rng.shuffle(paragraphs)
     return paragraphs
 
 def _get_next_sentence(sentence, next_sentence, paragraphs):
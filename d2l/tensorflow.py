@@ -543,6 +543,7 @@ class Vocab:
         self._token_freqs = sorted(counter.items(), key=lambda x: x[1],
                                    reverse=True)
         # 未知词元的索引为0
+        self.reserved_tokens = reserved_tokens
         self.idx_to_token = ['<unk>'] + reserved_tokens
         self.token_to_idx = {token: idx
                              for idx, token in enumerate(self.idx_to_token)}
@@ -701,21 +702,8 @@ def grad_clipping(grads, theta):
     """裁剪梯度
 
     Defined in :numref:`sec_rnn_scratch`"""
-    theta = tf.constant(theta, dtype=tf.float32)
-    new_grad = []
-    for grad in grads:
-        if isinstance(grad, tf.IndexedSlices):
-            new_grad.append(tf.convert_to_tensor(grad))
-        else:
-            new_grad.append(grad)
-    norm = tf.math.sqrt(sum((tf.reduce_sum(grad ** 2)).numpy()
-                        for grad in new_grad))
-    norm = tf.cast(norm, tf.float32)
-    if tf.greater(norm, theta):
-        for i, grad in enumerate(new_grad):
-            new_grad[i] = grad * theta / norm
-    else:
-        new_grad = new_grad
+    # 缩放系数为min(1,theta/norm)，范数始终留在设备上
+    new_grad, _ = tf.clip_by_global_norm(grads, theta)
     return new_grad
 
 def train_epoch_ch8(net, train_iter, loss, updater, use_random_iter):
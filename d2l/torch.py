@@ -17,9 +17,12 @@ nn_Module = nn.Module
 #    d2lbook build lib
 # Don't edit it directly
 
+import bisect
 import collections
+import contextlib
 import hashlib
 import math
+import multiprocessing
 import os
 import random
 import re
@@ -571,6 +574,7 @@ class Vocab:
         self._token_freqs = sorted(counter.items(), key=lambda x: x[1],
                                    reverse=True)
         # 未知词元的索引为0
+        self.reserved_tokens = reserved_tokens
         self.idx_to_token = ['<unk>'] + reserved_tokens
         self.token_to_idx = {token: idx
                              for idx, token in enumerate(self.idx_to_token)}
@@ -694,19 +698,42 @@ def load_data_time_machine(batch_size, num_steps,
 class RNNModelScratch:
     """从零开始实现的循环神经网络模型"""
     def __init__(self, vocab_size, num_hiddens, device,
-                 get_params, init_state, forward_fn):
+                 get_params, init_state, forward_fn, embedding=False):
         """Defined in :numref:`sec_rnn_scratch`"""
         self.vocab_size, self.num_hiddens = vocab_size, num_hiddens
         self.params = get_params(vocab_size, num_hiddens, device)
         self.init_state, self.forward_fn = init_state, forward_fn
+        # embedding为True时不构造独热编码，而是按词元索引取出输入权重的行
+        self.embedding = embedding
 
     def __call__(self, X, state):
-        X = F.one_hot(X.T, self.vocab_size).type(torch.float32)
+        if self.embedding:
+            X = OneHotIndices(X.T, self.vocab_size)
+        else:
+            X = F.one_hot(X.T, self.vocab_size).type(torch.float32)
         return self.forward_fn(X, state, self.params)
 
     def begin_state(self, batch_size, device):
         return self.init_state(batch_size, self.num_hiddens, device)
 
+class OneHotIndices:
+    """以词元索引表示的独热编码"""
+    def __init__(self, indices, num_classes):
+        """Defined in :numref:`sec_rnn_scratch`"""
+        self.indices, self.num_classes = indices, num_classes
+        self.shape = (*indices.shape, num_classes)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        # 沿第一个轴（时间步）迭代
+        return (OneHotIndices(X, self.num_classes) for X in self.indices)
+
+    def __matmul__(self, W):
+        # 独热编码与W相乘等价于取出W中对应的行
+        return W[self.indices]
+
 def predict_ch8(prefix, num_preds, net, vocab, device):
     """在prefix后面生成新字符
 
@@ -723,6 +750,59 @@ def predict_ch8(prefix, num_preds, net, vocab, device):
         outputs.append(int(y.argmax(dim=1).reshape(1)))
     return ''.join([vocab.idx_to_token[i] for i in outputs])
 
+def predict_ch8_batch(prefixes, num_preds, net, vocab, device,
+                      temperature=0, top_k=None):
+    """在多个prefix后面同时生成新字符
+
+    Defined in :numref:`sec_rnn_scratch`"""
+    if num_preds == 0:
+        return list(prefixes)
+    batch_size, lens = len(prefixes), [len(prefix) for prefix in prefixes]
+    num_steps, min_len = max(lens), min(lens)
+    # 与predict_ch8一样，预热期至少需要一个字符
+    if min_len == 0:
+        raise ValueError('每个prefix至少需要包含一个字符')
+    # 前缀右对齐，使它们在同一个时间步结束
+    X = torch.tensor([[0] * (num_steps - len(prefix)) + vocab[list(prefix)]
+                      for prefix in prefixes], device=device)
+    starts = num_steps - torch.tensor(lens, device=device)
+
+    def select_state(mask, new_state, state):
+        # 隐状态中每个张量的倒数第二个维度是批量维度
+        if isinstance(state, (tuple, list)):
+            return type(state)(select_state(mask, new, old)
+                               for new, old in zip(new_state, state))
+        return torch.where(mask.reshape(-1, 1), new_state, state)
+
+    def sample(y):
+        if temperature == 0:  # 贪心搜索
+            return y.argmax(dim=1)
+        y = y / temperature
+        if top_k is None:
+            return torch.multinomial(F.softmax(y, dim=1), 1).reshape(-1)
+        # 只在概率最高的top_k个词元中采样
+        values, indices = y.topk(top_k, dim=1)
+        return indices.gather(
+            1, torch.multinomial(F.softmax(values, dim=1), 1)).reshape(-1)
+
+    state = net.begin_state(batch_size=batch_size, device=device)
+    with torch.no_grad():
+        # 预热期：前缀开始之前保持其隐状态不变
+        for t in range(num_steps - min_len):
+            _, new_state = net(X[:, t:t + 1], state)
+            state = select_state(t >= starts, new_state, state)
+        # 所有前缀都已开始，余下的预热期只需调用一次net
+        y, state = net(X[:, num_steps - min_len:], state)
+        # 输出的行按时间步排列，最后batch_size行属于最后一个时间步
+        outputs = [sample(y[-batch_size:])]
+        for _ in range(num_preds - 1):  # 预测num_preds步
+            y, state = net(outputs[-1].reshape(-1, 1), state)
+            outputs.append(sample(y))
+    # 生成的词元只在最后复制到主机一次
+    outputs = torch.stack(outputs[:num_preds], dim=1).tolist()
+    return [prefix + ''.join(vocab.to_tokens(output))
+            for prefix, output in zip(prefixes, outputs)]
+
 def grad_clipping(net, theta):
     """裁剪梯度
 
@@ -731,10 +811,12 @@ def grad_clipping(net, theta):
         params = [p for p in net.parameters() if p.requires_grad]
     else:
         params = net.params
-    norm = torch.sqrt(sum(torch.sum((p.grad ** 2)) for p in params))
-    if norm > theta:
-        for param in params:
-            param.grad[:] *= theta / norm
+    grads = [p.grad for p in params if p.grad is not None]
+    if not grads:
+        return
+    norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+    # 范数不超过theta时缩放系数为1，因此无须判断，也不会造成设备同步
+    torch._foreach_mul_(grads, torch.clamp(theta / (norm + 1e-6), max=1))
 
 def train_epoch_ch8(net, train_iter, loss, updater, device, use_random_iter):
     """训练网络一个迭代周期（定义见第8章）
@@ -756,8 +838,10 @@ def train_epoch_ch8(net, train_iter, loss, updater, device, use_random_iter):
                     s.detach_()
         y = Y.T.reshape(-1)
         X, y = X.to(device), y.to(device)
-        y_hat, state = net(X, state)
-        l = loss(y_hat, y.long()).mean()
+        with d2l.approx_softmax(net) as head:
+            y_hat, state = net(X, state)
+        # 近似softmax输出层只为少量词元计算输出
+        l = (loss if head is None else head.loss)(y_hat, y.long()).mean()
         if isinstance(updater, torch.optim.Optimizer):
             updater.zero_grad()
             l.backward()
@@ -768,6 +852,10 @@ def train_epoch_ch8(net, train_iter, loss, updater, device, use_random_iter):
             grad_clipping(net, 1)
             # 因为已经调用了mean函数
             updater(batch_size=1)
+        if hasattr(head, 'exact_loss'):
+            # 采样softmax的损失不是交叉熵，困惑度用整个词表上精确的损失计算
+            with torch.no_grad():
+                l = head.exact_loss(y_hat, y.long()).mean()
         metric.add(l * d2l.size(y), d2l.size(y))
     return math.exp(metric[0] / metric[1]), metric[1] / timer.stop()
 
@@ -812,10 +900,17 @@ class RNNModel(nn.Module):
         else:
             self.num_directions = 2
             self.linear = nn.Linear(self.num_hiddens * 2, self.vocab_size)
+        # 如果循环层的输入维度不是词表大小，就用嵌入层代替独热编码
+        self.embedding = (
+            None if self.rnn.input_size == vocab_size
+            else nn.Embedding(vocab_size, self.rnn.input_size))
 
     def forward(self, inputs, state):
-        X = F.one_hot(inputs.T.long(), self.vocab_size)
-        X = X.to(torch.float32)
+        if self.embedding is None:
+            X = F.one_hot(inputs.T.long(), self.vocab_size)
+            X = X.to(torch.float32)
+        else:
+            X = self.embedding(inputs.T.long())
         Y, state = self.rnn(X, state)
         # 全连接层首先将Y的形状改为(时间步数*批量大小,隐藏单元数)
         # 它的输出形状是(时间步数*批量大小,词表大小)。
@@ -837,6 +932,196 @@ class RNNModel(nn.Module):
                         self.num_directions * self.rnn.num_layers,
                         batch_size, self.num_hiddens), device=device))
 
+def one_hot_to_embedding(net):
+    """将使用独热编码的RNNModel原地转换为使用嵌入层的等价模型
+
+    Defined in :numref:`sec_rnn-concise`"""
+    rnn = net.rnn
+    names = ['weight_ih_l0'] + (
+        ['weight_ih_l0_reverse'] if rnn.bidirectional else [])
+    # 第一层每个方向的输入权重形状为(门数*隐藏单元数，词表大小)，
+    # 它们的转置就是嵌入层的权重
+    W = torch.cat([getattr(rnn, name).detach() for name in names])
+    net.embedding = nn.Embedding.from_pretrained(W.T.clone(), freeze=False)
+    # 第一层每个方向的输入权重改为只选出嵌入中属于该方向的部分
+    rnn.input_size = W.shape[0]
+    for i, P in enumerate(torch.eye(W.shape[0], device=W.device,
+                                    dtype=W.dtype).chunk(len(names))):
+        setattr(rnn, names[i], nn.Parameter(P))
+    return net
+
+def adaptive_cutoffs(vocab, fractions=(0.8, 0.95)):
+    """按词频划分词表，使前几个簇的词元分别覆盖fractions比例的语料
+
+    Defined in :numref:`sec_rnn-concise`"""
+    counter = dict(vocab.token_freqs)
+    freqs = torch.tensor([counter.get(token, 0)
+                          for token in vocab.idx_to_token],
+                         dtype=torch.float64)
+    # 词表中除保留词元外的词元已经按词频从高到低排序
+    cum_freqs = torch.cumsum(freqs, dim=0) / freqs.sum()
+    fractions = torch.tensor(fractions, dtype=torch.float64)
+    cutoffs = torch.searchsorted(cum_freqs, fractions) + 1
+    return sorted({min(max(int(c), 1), len(vocab) - 1) for c in cutoffs})
+
+class AdaptiveSoftmax(nn.Module):
+    """自适应softmax输出层
+
+    Defined in :numref:`sec_rnn-concise`"""
+    def __init__(self, num_hiddens, vocab, fractions=(0.8, 0.95),
+                 div_value=4.0, **kwargs):
+        super(AdaptiveSoftmax, self).__init__(**kwargs)
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(
+            num_hiddens, len(vocab), adaptive_cutoffs(vocab, fractions),
+            div_value=div_value)
+        # 由approx_softmax设置，为True时前向传播直接返回输入
+        self.return_input = False
+
+    def forward(self, X):
+        if self.return_input:
+            return X
+        # 整个词表上精确的对数概率
+        return self.asm.log_prob(X.reshape(-1, X.shape[-1])).reshape(
+            *X.shape[:-1], -1)
+
+    def loss(self, X, y):
+        # 每个样本的负对数似然，只计算目标词元所在簇的输出
+        return -self.asm(X.reshape(-1, X.shape[-1]), y.reshape(-1)).output
+
+class SampledSoftmax(nn.Module):
+    """训练时只为目标词元和采样得到的词元计算输出的softmax输出层
+
+    Defined in :numref:`sec_rnn-concise`"""
+    def __init__(self, num_hiddens, vocab, num_samples, **kwargs):
+        super(SampledSoftmax, self).__init__(**kwargs)
+        self.linear = nn.Linear(num_hiddens, len(vocab))
+        self.num_samples = num_samples
+        counter = dict(vocab.token_freqs)
+        # 没有出现在语料中的词元（例如保留词元）按出现一次计算
+        freqs = torch.tensor([counter.get(token, 1)
+                              for token in vocab.idx_to_token],
+                             dtype=torch.float32)
+        # 与负采样相同，按词频的0.75次方采样
+        self.register_buffer('sampling_weights', freqs ** 0.75,
+                             persistent=False)
+        # 由approx_softmax设置，为True时前向传播直接返回输入
+        self.return_input = False
+
+    def forward(self, X):
+        # 整个词表上精确的输出
+        return X if self.return_input else self.linear(X)
+
+    def loss(self, X, y):
+        X, y = X.reshape(-1, X.shape[-1]), y.reshape(-1)
+        samples = torch.multinomial(self.sampling_weights, self.num_samples,
+                                    replacement=True)
+        # 减去每个词元被采样次数的期望的对数，修正采样带来的偏差
+        log_q = torch.log(self.num_samples * self.sampling_weights /
+                          self.sampling_weights.sum())
+        W, b = self.linear.weight, self.linear.bias
+        true_logits = (X * W[y]).sum(dim=-1) + b[y] - log_q[y]
+        sampled_logits = X @ W[samples].T + b[samples] - log_q[samples]
+        # 恰好采样到目标词元时，将其替换为一个非常大的负值
+        sampled_logits = sampled_logits.masked_fill(
+            samples == y.unsqueeze(-1), -1e6)
+        logits = torch.cat([true_logits.unsqueeze(-1), sampled_logits], -1)
+        # 目标词元的输出位于第0列
+        return F.cross_entropy(logits, torch.zeros_like(y), reduction='none')
+
+    def exact_loss(self, X, y):
+        # 整个词表上精确的交叉熵损失，训练时用于报告困惑度
+        return F.cross_entropy(self.linear(X.reshape(-1, X.shape[-1])),
+                               y.reshape(-1), reduction='none')
+
+@contextlib.contextmanager
+def approx_softmax(net):
+    """在with语句内让net中的近似softmax输出层直接返回输入，并生成该层
+
+    Defined in :numref:`sec_rnn-concise`"""
+    heads = []
+    if isinstance(net, nn.Module):
+        heads = [m for m in net.modules() if hasattr(m, 'return_input')]
+    for head in heads:
+        head.return_input = True
+    try:
+        yield heads[0] if heads else None
+    finally:
+        for head in heads:
+            head.return_input = False
+
+def lazy_script(fn):
+    """返回一个在第一次调用时才用TorchScript编译fn的函数
+
+    Defined in :numref:`sec_gru`"""
+    scripted = []
+    def wrapper(*args):
+        if not scripted:
+            scripted.append(torch.jit.script(fn))
+        return scripted[0](*args)
+    return wrapper
+
+@lazy_script
+def gru_loop(XW, H, W_hzr, W_hh):
+    """门控循环单元的时间步循环
+
+    Defined in :numref:`sec_gru`"""
+    # XW的形状：(时间步数，批量大小，3*隐藏单元数)，已经加上了偏置
+    num_hiddens = H.shape[1]
+    outputs = []
+    for X in XW.unbind(0):
+        # 更新门和重置门的两个矩阵乘法合并为一个
+        Z, R = torch.sigmoid(
+            X[:, :2 * num_hiddens] + H @ W_hzr).chunk(2, dim=1)
+        # 候选隐状态依赖于重置门，因此这个矩阵乘法无法与上面的合并
+        H_tilda = torch.tanh(X[:, 2 * num_hiddens:] + (R * H) @ W_hh)
+        H = Z * H + (1 - Z) * H_tilda
+        outputs.append(H)
+    return torch.stack(outputs), H
+
+def gru_fused(inputs, state, params):
+    """合并门的矩阵乘法并编译时间步循环的门控循环单元
+
+    Defined in :numref:`sec_gru`"""
+    W_xz, W_hz, b_z, W_xr, W_hr, b_r, W_xh, W_hh, b_h, W_hq, b_q = params
+    H, = state
+    # 所有时间步和所有门的输入变换只需一次矩阵乘法
+    XW = (inputs @ torch.cat((W_xz, W_xr, W_xh), 1) +
+          torch.cat((b_z, b_r, b_h)))
+    Hs, H = gru_loop(XW, H, torch.cat((W_hz, W_hr), 1), W_hh)
+    # 所有时间步的输出层也只需一次矩阵乘法
+    return Hs.reshape(-1, Hs.shape[-1]) @ W_hq + b_q, (H,)
+
+@d2l.lazy_script
+def lstm_loop(XW, H, C, W_h):
+    """长短期记忆网络的时间步循环
+
+    Defined in :numref:`sec_lstm`"""
+    # XW的形状：(时间步数，批量大小，4*隐藏单元数)，已经加上了偏置
+    num_hiddens = H.shape[1]
+    outputs = []
+    for X in XW.unbind(0):
+        # 四个门的矩阵乘法合并为一个
+        gates = X + H @ W_h
+        I, F, O = torch.sigmoid(gates[:, :3 * num_hiddens]).chunk(3, dim=1)
+        C_tilda = torch.tanh(gates[:, 3 * num_hiddens:])
+        C = F * C + I * C_tilda
+        H = O * torch.tanh(C)
+        outputs.append(H)
+    return torch.stack(outputs), H, C
+
+def lstm_fused(inputs, state, params):
+    """合并门的矩阵乘法并编译时间步循环的长短期记忆网络
+
+    Defined in :numref:`sec_lstm`"""
+    [W_xi, W_hi, b_i, W_xf, W_hf, b_f, W_xo, W_ho, b_o, W_xc, W_hc, b_c,
+     W_hq, b_q] = params
+    (H, C) = state
+    # 所有时间步和所有门的输入变换只需一次矩阵乘法
+    XW = (inputs @ torch.cat((W_xi, W_xf, W_xo, W_xc), 1) +
+          torch.cat((b_i, b_f, b_o, b_c)))
+    Hs, H, C = lstm_loop(XW, H, C, torch.cat((W_hi, W_hf, W_ho, W_hc), 1))
+    return Hs.reshape(-1, Hs.shape[-1]) @ W_hq + b_q, (H, C)
+
 d2l.DATA_HUB['fra-eng'] = (d2l.DATA_URL + 'fra-eng.zip',
                            '94646ad1522d915e7b0f9296181140edcf86a4f5')
 
@@ -948,6 +1233,15 @@ class Decoder(nn.Module):
     def forward(self, X, state):
         raise NotImplementedError
 
+    def reorder_state(self, state, index):
+        """按照index沿批量轴重排解码器状态，用于批量预测和束搜索"""
+        # 默认状态中所有张量的第一个轴都是批量轴，其他对象自行提供reorder方法
+        if isinstance(state, (list, tuple)):
+            return type(state)(self.reorder_state(s, index) for s in state)
+        if isinstance(state, torch.Tensor):
+            return state.index_select(0, index)
+        return state.reorder(index) if hasattr(state, 'reorder') else state
+
 class EncoderDecoder(nn.Module):
     """编码器-解码器架构的基类
 
@@ -967,18 +1261,29 @@ class Seq2SeqEncoder(d2l.Encoder):
 
     Defined in :numref:`sec_seq2seq`"""
     def __init__(self, vocab_size, embed_size, num_hiddens, num_layers,
-                 dropout=0, **kwargs):
+                 dropout=0, packed=False, **kwargs):
         super(Seq2SeqEncoder, self).__init__(**kwargs)
         # 嵌入层
         self.embedding = nn.Embedding(vocab_size, embed_size)
         self.rnn = nn.GRU(embed_size, num_hiddens, num_layers,
                           dropout=dropout)
+        self.packed = packed
 
     def forward(self, X, *args):
         # 输出'X'的形状：(batch_size,num_steps,embed_size)
         X = self.embedding(X)
         # 在循环神经网络模型中，第一个轴对应于时间步
         X = X.permute(1, 0, 2)
+        if self.packed and args and args[0] is not None:
+            # 按有效长度打包后，每个序列只计算到它的有效长度为止，
+            # state是每个序列最后一个有效时间步的隐状态
+            num_steps = X.shape[0]
+            X = nn.utils.rnn.pack_padded_sequence(
+                X, args[0].clamp(1, num_steps).cpu(), enforce_sorted=False)
+            output, state = self.rnn(X)
+            output, _ = nn.utils.rnn.pad_packed_sequence(
+                output, total_length=num_steps)
+            return output, state
         # 如果未提及状态，则默认为0
         output, state = self.rnn(X)
         # output的形状:(num_steps,batch_size,num_hiddens)
@@ -1011,7 +1316,8 @@ class MaskedSoftmaxCELoss(nn.CrossEntropyLoss):
         weighted_loss = (unweighted_loss * weights).mean(dim=1)
         return weighted_loss
 
-def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device):
+def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device,
+                  val_iter=None):
     """训练序列到序列模型
 
     Defined in :numref:`sec_seq2seq_decoder`"""
@@ -1029,7 +1335,8 @@ def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device):
     loss = MaskedSoftmaxCELoss()
     net.train()
     animator = d2l.Animator(xlabel='epoch', ylabel='loss',
-                     xlim=[10, num_epochs])
+                     xlim=[10, num_epochs],
+                     legend=None if val_iter is None else ['loss', 'val bleu'])
     for epoch in range(num_epochs):
         timer = d2l.Timer()
         metric = d2l.Accumulator(2)  # 训练损失总和，词元数量
@@ -1047,9 +1354,16 @@ def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device):
             optimizer.step()
             with torch.no_grad():
                 metric.add(l.sum(), num_tokens)
+        timer.stop()
         if (epoch + 1) % 10 == 0:
-            animator.add(epoch + 1, (metric[0] / metric[1],))
-    print(f'loss {metric[0] / metric[1]:.3f}, {metric[1] / timer.stop():.1f} '
+            if val_iter is None:
+                animator.add(epoch + 1, (metric[0] / metric[1],))
+            else:
+                # 在验证集上用贪心搜索评估语料库级的BLEU（稍后讨论）
+                val_bleu = d2l.evaluate_bleu_seq2seq(net, val_iter, tgt_vocab,
+                                                     device)
+                animator.add(epoch + 1, (metric[0] / metric[1], val_bleu))
+    print(f'loss {metric[0] / metric[1]:.3f}, {metric[1] / timer.sum():.1f} '
         f'tokens/sec on {str(device)}')
 
 def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps,
@@ -1066,24 +1380,33 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps,
     # 添加批量轴
     enc_X = torch.unsqueeze(
         torch.tensor(src_tokens, dtype=torch.long, device=device), dim=0)
-    enc_outputs = net.encoder(enc_X, enc_valid_len)
-    dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
-    # 添加批量轴
-    dec_X = torch.unsqueeze(torch.tensor(
-        [tgt_vocab['<bos>']], dtype=torch.long, device=device), dim=0)
     output_seq, attention_weight_seq = [], []
-    for _ in range(num_steps):
-        Y, dec_state = net.decoder(dec_X, dec_state)
-        # 我们使用具有预测最高可能性的词元，作为解码器在下一时间步的输入
-        dec_X = Y.argmax(dim=2)
-        pred = dec_X.squeeze(dim=0).type(torch.int32).item()
-        # 保存注意力权重（稍后讨论）
-        if save_attention_weights:
-            attention_weight_seq.append(net.decoder.attention_weights)
-        # 一旦序列结束词元被预测，输出序列的生成就完成了
-        if pred == tgt_vocab['<eos>']:
-            break
-        output_seq.append(pred)
+    # 只在需要时让注意力层保存注意力权重
+    with (d2l.capture_attention(net) if save_attention_weights
+          else contextlib.nullcontext()):
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        # 支持键值缓存的解码器在每个时间步只为新的词元计算键和值（稍后讨论）
+        dec_state = None
+        if hasattr(net.decoder, 'init_cached_state'):
+            dec_state = net.decoder.init_cached_state(
+                enc_outputs, enc_valid_len, num_steps)
+        if dec_state is None:
+            dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        # 添加批量轴
+        dec_X = torch.unsqueeze(torch.tensor(
+            [tgt_vocab['<bos>']], dtype=torch.long, device=device), dim=0)
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            # 我们使用具有预测最高可能性的词元，作为解码器在下一时间步的输入
+            dec_X = Y.argmax(dim=2)
+            pred = dec_X.squeeze(dim=0).type(torch.int32).item()
+            # 保存注意力权重（稍后讨论）
+            if save_attention_weights:
+                attention_weight_seq.append(net.decoder.attention_weights)
+            # 一旦序列结束词元被预测，输出序列的生成就完成了
+            if pred == tgt_vocab['<eos>']:
+                break
+            output_seq.append(pred)
     return ' '.join(tgt_vocab.to_tokens(output_seq)), attention_weight_seq
 
 def bleu(pred_seq, label_seq, k):
@@ -1104,6 +1427,151 @@ def bleu(pred_seq, label_seq, k):
         score *= math.pow(num_matches / (len_pred - n + 1), math.pow(0.5, n))
     return score
 
+def predict_seq2seq_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps,
+                          device, beam_size=1, alpha=0.75, batch_size=256):
+    """序列到序列模型的批量预测，beam_size为1时使用贪心搜索
+
+    Defined in :numref:`sec_seq2seq_training`"""
+    net.eval()
+    translations = []
+    for i in range(0, len(src_sentences), batch_size):
+        src_tokens = [src_vocab[s.lower().split(' ')] + [src_vocab['<eos>']]
+                      for s in src_sentences[i: i + batch_size]]
+        enc_valid_len = torch.tensor([len(t) for t in src_tokens],
+                                     device=device)
+        enc_X = torch.tensor([d2l.truncate_pad(t, num_steps, src_vocab['<pad>'])
+                              for t in src_tokens], dtype=torch.long,
+                             device=device)
+        with torch.no_grad():
+            seqs = _beam_search(net, enc_X, enc_valid_len, tgt_vocab,
+                                num_steps, beam_size, alpha)
+        for seq in seqs.tolist():
+            # 丢弃“<eos>”及其之后的部分
+            if tgt_vocab['<eos>'] in seq:
+                seq = seq[:seq.index(tgt_vocab['<eos>'])]
+            translations.append(' '.join(tgt_vocab.to_tokens(seq)))
+    return translations
+
+def _beam_search(net, enc_X, enc_valid_len, tgt_vocab, num_steps, beam_size,
+                 alpha):
+    """对一个小批量的源序列进行束搜索，返回每个源序列的最佳输出序列
+
+    Defined in :numref:`sec_seq2seq_training`"""
+    batch_size, device = enc_X.shape[0], enc_X.device
+    eos = tgt_vocab['<eos>']
+    enc_outputs = net.encoder(enc_X, enc_valid_len)
+    dec_state = None
+    if hasattr(net.decoder, 'init_cached_state'):
+        dec_state = net.decoder.init_cached_state(enc_outputs, enc_valid_len,
+                                                  num_steps)
+    if dec_state is None:
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+    # 每个源序列复制beam_size份，共n个候选序列
+    n = batch_size * beam_size
+    offsets = torch.arange(batch_size, device=device) * beam_size
+    if beam_size > 1:
+        dec_state = net.decoder.reorder_state(dec_state, torch.arange(
+            batch_size, device=device).repeat_interleave(beam_size))
+    dec_X = torch.full((n, 1), tgt_vocab['<bos>'], dtype=torch.long,
+                       device=device)
+    # 第一个时间步只从每个源序列的第一个候选序列扩展，避免重复
+    scores = torch.zeros(batch_size, beam_size, device=device)
+    scores[:, 1:] = float('-inf')
+    seqs = torch.zeros((n, 0), dtype=torch.long, device=device)
+    lengths = torch.zeros(n, device=device)
+    finished = torch.zeros(n, dtype=torch.bool, device=device)
+    for _ in range(num_steps):
+        Y, dec_state = net.decoder(dec_X, dec_state)
+        log_probs = torch.log_softmax(Y[:, -1].float(), dim=-1)
+        vocab_size = log_probs.shape[-1]
+        # 已结束的候选序列只能以零得分继续“生成”<eos>
+        eos_only = torch.full((vocab_size,), float('-inf'), device=device)
+        eos_only[eos] = 0
+        log_probs = torch.where(finished.unsqueeze(1), eos_only, log_probs)
+        candidates = (scores.reshape(n, 1) + log_probs).reshape(batch_size, -1)
+        scores, indices = candidates.topk(beam_size, dim=1)
+        # index是被选中的候选序列在上一时间步的n个候选序列中的位置
+        index = (offsets.unsqueeze(1) + indices // vocab_size).reshape(-1)
+        tokens = (indices % vocab_size).reshape(-1, 1)
+        seqs = torch.cat((seqs[index], tokens), dim=1)
+        lengths = lengths[index] + (~finished[index]).float()
+        finished = finished[index] | (tokens.squeeze(1) == eos)
+        if beam_size > 1:
+            dec_state = net.decoder.reorder_state(dec_state, index)
+        dec_X = tokens
+        # 每个时间步只同步一次整个小批量，而不是每个词元同步一次
+        if finished.all():
+            break
+    # 长度归一化后，选出每个源序列得分最高的候选序列
+    scores = scores / lengths.reshape(batch_size, beam_size) ** alpha
+    best = offsets + scores.argmax(dim=1)
+    return seqs[best]
+
+def corpus_bleu(pred_seqs, label_seqs, k):
+    """计算语料库级的BLEU，pred_seqs和label_seqs是词元索引序列的列表
+
+    Defined in :numref:`sec_seq2seq_training`"""
+    seqs = list(pred_seqs) + list(label_seqs)
+    lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    len_pred = lens[:len(pred_seqs)].sum()
+    len_label = lens[len(pred_seqs):].sum()
+    if len_pred == 0:
+        return 0.0
+    # 将所有序列连结成一个词元数组，预测序列和标签序列按照索引一一对应
+    tokens = np.fromiter((t for seq in seqs for t in seq), dtype=np.int64,
+                         count=lens.sum())
+    seq_ids = np.repeat(np.concatenate((np.arange(len(pred_seqs)),
+                                        np.arange(len(label_seqs)))), lens)
+    is_pred = np.arange(len(tokens)) < len_pred
+    # 每个位置所在序列从该位置开始还剩下的词元数
+    remaining = np.repeat(np.cumsum(lens), lens) - np.arange(len(tokens))
+    score = math.exp(min(0, 1 - len_label / len_pred))
+    codes, base = tokens, tokens.max() + 1
+    for n in range(1, k + 1):
+        if n > 1:
+            # 从(n-1)元语法的编号和第n个词元得到n元语法的整数编号，
+            # 再重新编号为连续的整数以免溢出
+            _, codes = np.unique(codes[:-1] * base + tokens[n - 1:],
+                                 return_inverse=True)
+        # 只保留不跨越序列边界的n元语法
+        valid = remaining[:len(codes)] >= n
+        pred_mask = valid & is_pred[:len(codes)]
+        label_mask = valid & ~is_pred[:len(codes)]
+        if not pred_mask.any():
+            return 0.0
+        keys = seq_ids[:len(codes)] * (codes.max() + 1) + codes
+        pred_keys, pred_counts = np.unique(keys[pred_mask], return_counts=True)
+        label_keys, label_counts = np.unique(keys[label_mask],
+                                             return_counts=True)
+        # 匹配数量取n元语法在预测序列和标签序列中出现次数的较小值
+        _, i, j = np.intersect1d(pred_keys, label_keys, assume_unique=True,
+                                 return_indices=True)
+        num_matches = np.minimum(pred_counts[i], label_counts[j]).sum()
+        score *= math.pow(num_matches / pred_mask.sum(), math.pow(0.5, n))
+    return score
+
+def evaluate_bleu_seq2seq(net, data_iter, tgt_vocab, device, k=2,
+                          beam_size=1):
+    """计算模型在数据集上的语料库级BLEU
+
+    Defined in :numref:`sec_seq2seq_training`"""
+    was_training = net.training
+    net.eval()
+    pred_seqs, label_seqs = [], []
+    eos = tgt_vocab['<eos>']
+    for X, X_valid_len, Y, Y_valid_len in data_iter:
+        X, X_valid_len = X.to(device), X_valid_len.to(device)
+        with torch.no_grad():
+            seqs = _beam_search(net, X, X_valid_len, tgt_vocab, Y.shape[1],
+                                beam_size, 0.75)
+        for seq in seqs.tolist():
+            pred_seqs.append(seq[:seq.index(eos)] if eos in seq else seq)
+        # 有效长度包含了标签序列末尾的“<eos>”
+        label_seqs.extend(y[:l - 1] for y, l in zip(Y.tolist(),
+                                                    Y_valid_len.tolist()))
+    net.train(was_training)
+    return corpus_bleu(pred_seqs, label_seqs, k)
+
 def show_heatmaps(matrices, xlabel, ylabel, titles=None, figsize=(2.5, 2.5),
                   cmap='Reds'):
     """显示矩阵热图
@@ -1124,37 +1592,53 @@ def show_heatmaps(matrices, xlabel, ylabel, titles=None, figsize=(2.5, 2.5),
                 ax.set_title(titles[j])
     fig.colorbar(pcm, ax=axes, shrink=0.6);
 
+def _attention_mask(valid_lens, num_keys):
+    """由有效长度通过广播生成布尔掩码，True表示保留
+
+    Defined in :numref:`sec_attention-scoring-functions`"""
+    # valid_lens为1D张量时，掩码的形状为(batch_size，1，num_keys)，
+    # 为2D张量时，形状为(batch_size，查询的个数，num_keys)
+    if valid_lens.dtype == torch.bool:
+        return valid_lens
+    if valid_lens.dim() == 1:
+        valid_lens = valid_lens[:, None]
+    return (torch.arange(num_keys, device=valid_lens.device)
+            < valid_lens[..., None])
+
 def masked_softmax(X, valid_lens):
     """通过在最后一个轴上掩蔽元素来执行softmax操作
 
     Defined in :numref:`sec_attention-scoring-functions`"""
-    # X:3D张量，valid_lens:1D或2D张量
+    # X:3D张量，valid_lens:1D或2D张量，或与X形状相同的布尔掩码（True表示保留）
     if valid_lens is None:
         return nn.functional.softmax(X, dim=-1)
-    else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            valid_lens = torch.repeat_interleave(valid_lens, shape[1])
-        else:
-            valid_lens = valid_lens.reshape(-1)
-        # 最后一轴上被掩蔽的元素使用一个非常大的负值替换，从而其softmax输出为0
-        X = d2l.sequence_mask(X.reshape(-1, shape[-1]), valid_lens,
-                              value=-1e6)
-        return nn.functional.softmax(X.reshape(shape), dim=-1)
+    # 最后一轴上被掩蔽的元素使用一个非常大的负值替换，从而其softmax输出为0。
+    # 掩码通过广播得到，无需重复valid_lens，也无需布尔索引
+    mask = _attention_mask(valid_lens, X.shape[-1])
+    # 不原地填充，以免修改调用者的张量
+    return nn.functional.softmax(X.masked_fill(~mask, -1e6), dim=-1)
 
 class AdditiveAttention(nn.Module):
     """加性注意力
 
     Defined in :numref:`sec_attention-scoring-functions`"""
-    def __init__(self, key_size, query_size, num_hiddens, dropout, **kwargs):
+    def __init__(self, key_size, query_size, num_hiddens, dropout,
+                 chunk_size=None, **kwargs):
         super(AdditiveAttention, self).__init__(**kwargs)
         self.W_k = nn.Linear(key_size, num_hiddens, bias=False)
         self.W_q = nn.Linear(query_size, num_hiddens, bias=False)
         self.w_v = nn.Linear(num_hiddens, 1, bias=False)
         self.dropout = nn.Dropout(dropout)
+        # chunk_size不为None时，每次只为chunk_size个键计算特征
+        self.chunk_size = chunk_size
+        # 只有need_weights为True时才保存注意力权重（见capture_attention）
+        self.need_weights = False
 
     def forward(self, queries, keys, values, valid_lens):
         queries, keys = self.W_q(queries), self.W_k(keys)
+        self.attention_weights = None
+        if self.chunk_size is not None and not self.need_weights:
+            return self._chunked_forward(queries, keys, values, valid_lens)
         # 在维度扩展后，
         # queries的形状：(batch_size，查询的个数，1，num_hidden)
         # key的形状：(batch_size，1，“键－值”对的个数，num_hiddens)
@@ -1164,28 +1648,110 @@ class AdditiveAttention(nn.Module):
         # self.w_v仅有一个输出，因此从形状中移除最后那个维度。
         # scores的形状：(batch_size，查询的个数，“键-值”对的个数)
         scores = self.w_v(features).squeeze(-1)
-        self.attention_weights = masked_softmax(scores, valid_lens)
+        attention_weights = masked_softmax(scores, valid_lens)
+        if self.need_weights:
+            # 保存的注意力权重不参与反向传播
+            self.attention_weights = attention_weights.detach()
         # values的形状：(batch_size，“键－值”对的个数，值的维度)
-        return torch.bmm(self.dropout(self.attention_weights), values)
+        return torch.bmm(self.dropout(attention_weights), values)
+
+    def _scores(self, queries, keys):
+        # 形状为(batch_size，查询的个数，键的个数，num_hiddens)的特征
+        # 只在这里临时存在
+        features = torch.tanh(queries.unsqueeze(2) + keys.unsqueeze(1))
+        return self.w_v(features).squeeze(-1)
+
+    def _chunked_forward(self, queries, keys, values, valid_lens):
+        """逐块处理键，用在线softmax累积输出，不计算注意力权重"""
+        mask = (None if valid_lens is None
+                else _attention_mask(valid_lens, keys.shape[1]))
+        # 每个查询到目前为止的最大分数、指数之和以及值的加权和
+        max_score = torch.full((*queries.shape[:2], 1), -float('inf'),
+                               dtype=queries.dtype, device=queries.device)
+        denom = torch.zeros_like(max_score)
+        output = torch.zeros((*queries.shape[:2], values.shape[-1]),
+                             dtype=values.dtype, device=values.device)
+        for i in range(0, keys.shape[1], self.chunk_size):
+            j = i + self.chunk_size
+            if torch.is_grad_enabled():
+                # 反向传播时重新计算特征，只保存形状为
+                # (batch_size，查询的个数，chunk_size)的分数
+                scores = torch.utils.checkpoint.checkpoint(
+                    self._scores, queries, keys[:, i:j], use_reentrant=False)
+            else:
+                scores = self._scores(queries, keys[:, i:j])
+            if mask is not None:
+                # 与masked_softmax一致，被掩蔽的分数替换为一个非常大的负值
+                scores = scores.masked_fill(~mask[..., i:j], -1e6)
+            new_max = torch.maximum(
+                max_score, scores.max(dim=-1, keepdim=True).values)
+            # 最大分数变大时，按比例缩小之前累积的指数之和与加权和
+            scale = torch.exp(max_score - new_max)
+            p = torch.exp(scores - new_max)
+            denom = denom * scale + p.sum(dim=-1, keepdim=True)
+            output = output * scale + torch.bmm(self.dropout(p),
+                                                values[:, i:j])
+            max_score = new_max
+        return output / denom
+
+@contextlib.contextmanager
+def capture_attention(net):
+    """在with语句内保存net中各注意力层的注意力权重
+
+    Defined in :numref:`subsec_additive-attention`"""
+    weights, hooks, flags = {}, [], []
+    for name, module in net.named_modules():
+        if not hasattr(module, 'need_weights'):
+            continue
+        flags.append((module, module.need_weights))
+        module.need_weights = True
+        hooks.append(module.register_forward_hook(
+            lambda m, inputs, output, name=name:
+            weights.setdefault(name, []).append(m.attention_weights)))
+    try:
+        # weights将每个注意力层的名字映射到其每次前向传播的注意力权重
+        yield weights
+    finally:
+        for hook in hooks:
+            hook.remove()
+        for module, flag in flags:
+            module.need_weights = flag
 
 class DotProductAttention(nn.Module):
     """缩放点积注意力
 
     Defined in :numref:`subsec_additive-attention`"""
-    def __init__(self, dropout, **kwargs):
+    def __init__(self, dropout, use_sdpa=False, **kwargs):
         super(DotProductAttention, self).__init__(**kwargs)
         self.dropout = nn.Dropout(dropout)
+        # 只有need_weights为True时才保存注意力权重（见capture_attention），
+        # 此时也不使用融合的实现
+        self.use_sdpa, self.need_weights = use_sdpa, False
 
     # queries的形状：(batch_size，查询的个数，d)
     # keys的形状：(batch_size，“键－值”对的个数，d)
     # values的形状：(batch_size，“键－值”对的个数，值的维度)
     # valid_lens的形状:(batch_size，)或者(batch_size，查询的个数)
     def forward(self, queries, keys, values, valid_lens=None):
+        self.attention_weights = None
+        if self.use_sdpa and not self.need_weights:
+            # 使用PyTorch融合的缩放点积注意力
+            attn_mask = None
+            if valid_lens is not None:
+                # 与masked_softmax一致，被掩蔽的位置加上一个非常大的负值
+                attn_mask = torch.zeros((), dtype=queries.dtype,
+                                        device=queries.device).masked_fill(
+                    ~_attention_mask(valid_lens, keys.shape[1]), -1e6)
+            return nn.functional.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0)
         d = queries.shape[-1]
         # 设置transpose_b=True为了交换keys的最后两个维度
         scores = torch.bmm(queries, keys.transpose(1,2)) / math.sqrt(d)
-        self.attention_weights = masked_softmax(scores, valid_lens)
-        return torch.bmm(self.dropout(self.attention_weights), values)
+        attention_weights = masked_softmax(scores, valid_lens)
+        if self.need_weights:
+            self.attention_weights = attention_weights.detach()
+        return torch.bmm(self.dropout(attention_weights), values)
 
 class AttentionDecoder(d2l.Decoder):
     """带有注意力机制解码器的基本接口
@@ -1194,6 +1760,11 @@ class AttentionDecoder(d2l.Decoder):
     def __init__(self, **kwargs):
         super(AttentionDecoder, self).__init__(**kwargs)
 
+    def init_cached_state(self, enc_outputs, enc_valid_lens, max_len):
+        """返回使用键值缓存逐词元解码时的初始状态，
+        不支持键值缓存的解码器返回None"""
+        return None
+
     @property
     def attention_weights(self):
         raise NotImplementedError
@@ -1203,16 +1774,22 @@ class MultiHeadAttention(nn.Module):
 
     Defined in :numref:`sec_multihead-attention`"""
     def __init__(self, key_size, query_size, value_size, num_hiddens,
-                 num_heads, dropout, bias=False, **kwargs):
+                 num_heads, dropout, bias=False, use_sdpa=False,
+                 fused_qkv=False, **kwargs):
         super(MultiHeadAttention, self).__init__(**kwargs)
         self.num_heads = num_heads
-        self.attention = d2l.DotProductAttention(dropout)
-        self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
-        self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
-        self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
+        self.attention = d2l.DotProductAttention(dropout, use_sdpa)
+        if fused_qkv:
+            # 将W_q、W_k和W_v的权重按行拼接，自注意力时只需一次矩阵乘法
+            assert key_size == query_size == value_size
+            self.W_qkv = nn.Linear(query_size, 3 * num_hiddens, bias=bias)
+        else:
+            self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
+            self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
+            self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias=bias)
 
-    def forward(self, queries, keys, values, valid_lens):
+    def forward(self, queries, keys, values, valid_lens, cache=None):
         # queries，keys，values的形状:
         # (batch_size，查询或者“键－值”对的个数，num_hiddens)
         # valid_lens　的形状:
@@ -1220,9 +1797,17 @@ class MultiHeadAttention(nn.Module):
         # 经过变换后，输出的queries，keys，values　的形状:
         # (batch_size*num_heads，查询或者“键－值”对的个数，
         # num_hiddens/num_heads)
-        queries = transpose_qkv(self.W_q(queries), self.num_heads)
-        keys = transpose_qkv(self.W_k(keys), self.num_heads)
-        values = transpose_qkv(self.W_v(values), self.num_heads)
+        if cache is not None:
+            return self._cached_forward(queries, keys, values, valid_lens,
+                                        cache)
+        if self.attention.use_sdpa and not self.attention.need_weights:
+            return self.W_o(self._attend(*[
+                self._split_heads(X)
+                for X in self._project(queries, keys, values)], valid_lens))
+        queries, keys, values = self._project(queries, keys, values)
+        queries = transpose_qkv(queries, self.num_heads)
+        keys = transpose_qkv(keys, self.num_heads)
+        values = transpose_qkv(values, self.num_heads)
 
         if valid_lens is not None:
             # 在轴0，将第一项（标量或者矢量）复制num_heads次，
@@ -1238,6 +1823,104 @@ class MultiHeadAttention(nn.Module):
         output_concat = transpose_output(output, self.num_heads)
         return self.W_o(output_concat)
 
+    def _project(self, queries, keys, values):
+        """计算查询、键和值的线性变换，为None的输入不做计算"""
+        if hasattr(self, 'W_qkv') and queries is keys and keys is values:
+            # 自注意力：一次矩阵乘法，再沿最后一个轴切分为三个视图
+            return self.W_qkv(queries).chunk(3, dim=-1)
+        if hasattr(self, 'W_qkv'):
+            weights = self.W_qkv.weight.chunk(3)
+            biases = (self.W_qkv.bias.chunk(3) if self.W_qkv.bias is not None
+                      else (None,) * 3)
+        else:
+            weights = [W.weight for W in (self.W_q, self.W_k, self.W_v)]
+            biases = [W.bias for W in (self.W_q, self.W_k, self.W_v)]
+        return [None if X is None else nn.functional.linear(X, W, b)
+                for X, W, b in zip((queries, keys, values), weights, biases)]
+
+    def _split_heads(self, X):
+        """返回形状为(batch_size，num_heads，查询或者“键－值”对的个数，
+        num_hiddens/num_heads)的视图，不复制数据"""
+        return X.unflatten(-1, (self.num_heads, -1)).transpose(1, 2)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 加载时在分开的W_q、W_k、W_v与合并的W_qkv之间转换参数，
+        # 使两种形式保存的模型参数可以互相加载
+        for name in ('weight', 'bias'):
+            qkv = [f'{prefix}W_{c}.{name}' for c in 'qkv']
+            fused = f'{prefix}W_qkv.{name}'
+            if hasattr(self, 'W_qkv') and all(k in state_dict for k in qkv):
+                state_dict[fused] = torch.cat([state_dict.pop(k) for k in qkv])
+            elif not hasattr(self, 'W_qkv') and fused in state_dict:
+                for k, v in zip(qkv, state_dict.pop(fused).chunk(3)):
+                    state_dict[k] = v
+        super(MultiHeadAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def _attend(self, queries, keys, values, valid_lens):
+        """queries，keys，values的形状:(batch_size，num_heads，
+        查询或者“键－值”对的个数，num_hiddens/num_heads)"""
+        if valid_lens is not None:
+            # 掩码的形状:(batch_size，1，1或查询的个数，“键－值”对的个数)，
+            # 在头的维度上广播，无需复制num_heads次
+            valid_lens = d2l._attention_mask(
+                valid_lens, keys.shape[2]).unsqueeze(1)
+        if self.attention.use_sdpa and not self.attention.need_weights:
+            # 调用融合的缩放点积注意力
+            output = self.attention(queries, keys, values, valid_lens)
+        else:
+            # 合并批量和头的维度后使用torch.bmm，注意力权重的形状与
+            # forward中的相同
+            if valid_lens is not None:
+                valid_lens = valid_lens.expand(
+                    -1, self.num_heads, -1, -1).flatten(0, 1)
+            output = self.attention(
+                queries.flatten(0, 1), keys.flatten(0, 1),
+                values.flatten(0, 1), valid_lens).unflatten(
+                0, (-1, self.num_heads))
+        # 返回的形状:(batch_size，查询的个数，num_hiddens)，尚未经过W_o变换
+        return output.transpose(1, 2).flatten(2)
+
+    def init_cache(self, batch_size, max_len, keys=None, values=None):
+        """为增量解码创建键值缓存
+
+        给定keys和values（例如编码器的输出）时，只计算一次它们的线性变换；
+        否则预先分配能容纳max_len个键和值的缓冲区"""
+        if keys is not None:
+            _, keys, values = self._project(None, keys, values)
+            keys, values = [self._split_heads(X).contiguous()
+                            for X in (keys, values)]
+            return d2l.KVCache(keys, values, keys.shape[2])
+        W = self.W_o.weight
+        shape = (batch_size, self.num_heads, max_len,
+                 W.shape[1] // self.num_heads)
+        return d2l.KVCache(W.new_empty(shape), W.new_empty(shape), 0)
+
+    def _cached_forward(self, queries, keys, values, valid_lens, cache):
+        """增量解码：只为新的键和值计算线性变换，并追加到缓存中；
+        keys和values为None时直接使用缓存中的键和值"""
+        queries, keys, values = [
+            None if X is None else self._split_heads(X)
+            for X in self._project(queries, keys, values)]
+        if keys is not None:
+            cache.append(keys, values)
+        keys, values = cache.get()
+        return self.W_o(self._attend(queries, keys, values, valid_lens))
+
+    def unpadded_forward(self, X, valid_lens, indices, num_steps):
+        """去掉填充的自注意力
+
+        X的形状为(有效词元总数，num_hiddens)，indices是这些词元在展平的
+        (batch_size*num_steps)个位置中的索引。线性变换只对有效词元计算，
+        只有注意力计算时才临时填充"""
+        batch_size = valid_lens.shape[0]
+        queries, keys, values = [
+            self._split_heads(d2l._pad_tokens(Y, indices, batch_size,
+                                              num_steps))
+            for Y in self._project(X, X, X)]
+        output = self._attend(queries, keys, values, valid_lens)
+        return self.W_o(output.flatten(0, 1)[indices])
+
 def transpose_qkv(X, num_heads):
     """为了多注意力头的并行计算而变换形状
 
@@ -1264,6 +1947,51 @@ def transpose_output(X, num_heads):
     X = X.permute(0, 2, 1, 3)
     return X.reshape(X.shape[0], X.shape[1], -1)
 
+class KVCache:
+    """多头注意力的键值缓存"""
+    def __init__(self, keys, values, length):
+        """Defined in :numref:`sec_multihead-attention`"""
+        # 缓冲区的形状:(batch_size，num_heads，最大长度，
+        # num_hiddens/num_heads)，前length个位置保存了已经计算的键和值
+        self.buffers, self.length = [keys, values], length
+
+    def append(self, keys, values):
+        """将新的键和值写入缓冲区"""
+        new_length = self.length + keys.shape[2]
+        if new_length > self.buffers[0].shape[2]:
+            # 缓冲区已满时，将其长度至少扩大一倍
+            size = max(new_length, 2 * self.buffers[0].shape[2])
+            self.buffers = [torch.cat((B[:, :, :self.length], B.new_empty(
+                (*B.shape[:2], size - self.length, B.shape[3]))), dim=2)
+                for B in self.buffers]
+        for B, X in zip(self.buffers, (keys, values)):
+            B[:, :, self.length:new_length] = X
+        self.length = new_length
+
+    def get(self):
+        """返回到目前为止所有的键和值"""
+        return [B[:, :, :self.length] for B in self.buffers]
+
+    def reorder(self, index):
+        """按照index沿批量轴重排缓存，用于束搜索"""
+        return KVCache(*[B.index_select(0, index) for B in self.buffers],
+                       self.length)
+
+def _unpad_indices(valid_lens, num_steps):
+    """返回有效词元在展平的(batch_size*num_steps)个位置中的索引
+
+    Defined in :numref:`sec_multihead-attention`"""
+    return d2l._attention_mask(valid_lens, num_steps).flatten().nonzero(
+        ).squeeze(1)
+
+def _pad_tokens(X, indices, batch_size, num_steps):
+    """将形状为(有效词元总数，…)的X放回形状为(batch_size，num_steps，…)
+    的填充后的张量，填充位置为0
+
+    Defined in :numref:`sec_multihead-attention`"""
+    return X.new_zeros((batch_size * num_steps, *X.shape[1:])).index_copy(
+        0, indices, X).unflatten(0, (batch_size, num_steps))
+
 class PositionalEncoding(nn.Module):
     """位置编码
 
@@ -1271,16 +1999,38 @@ class PositionalEncoding(nn.Module):
     def __init__(self, num_hiddens, dropout, max_len=1000):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(dropout)
-        # 创建一个足够长的P
-        self.P = d2l.zeros((1, max_len, num_hiddens))
-        X = d2l.arange(max_len, dtype=torch.float32).reshape(
+        self.num_hiddens = num_hiddens
+        # 创建一个足够长的P，作为缓冲区随net.to()移动到相应的设备上，
+        # 但不保存在state_dict中
+        self.register_buffer('P', self._encoding(max_len), persistent=False)
+        # 按数据类型缓存的P
+        self._P_cache = {}
+
+    def _encoding(self, max_len, device=None):
+        P = d2l.zeros((1, max_len, self.num_hiddens), device=device)
+        X = d2l.arange(max_len, dtype=torch.float32, device=device).reshape(
             -1, 1) / torch.pow(10000, torch.arange(
-            0, num_hiddens, 2, dtype=torch.float32) / num_hiddens)
-        self.P[:, :, 0::2] = torch.sin(X)
-        self.P[:, :, 1::2] = torch.cos(X)
+            0, self.num_hiddens, 2, dtype=torch.float32,
+            device=device) / self.num_hiddens)
+        P[:, :, 0::2] = torch.sin(X)
+        P[:, :, 1::2] = torch.cos(X)
+        return P
+
+    def _get_P(self, dtype):
+        # 半精度的模型直接与同样精度的P相加，避免提升为float32
+        if dtype == self.P.dtype:
+            return self.P
+        P = self._P_cache.get(dtype)
+        if P is None or P.shape != self.P.shape or P.device != self.P.device:
+            P = self._P_cache[dtype] = self.P.to(dtype)
+        return P
 
     def forward(self, X):
-        X = X + self.P[:, :X.shape[1], :].to(X.device)
+        if X.shape[1] > self.P.shape[1]:
+            # 序列比P长时，将P的长度至少扩大一倍
+            self.P = self._encoding(max(X.shape[1], 2 * self.P.shape[1]),
+                                    self.P.device).to(self.P.dtype)
+        X = X + self._get_P(X.dtype)[:, :X.shape[1], :]
         return self.dropout(X)
 
 class PositionWiseFFN(nn.Module):
@@ -1315,18 +2065,25 @@ class EncoderBlock(nn.Module):
     Defined in :numref:`sec_transformer`"""
     def __init__(self, key_size, query_size, value_size, num_hiddens,
                  norm_shape, ffn_num_input, ffn_num_hiddens, num_heads,
-                 dropout, use_bias=False, **kwargs):
+                 dropout, use_bias=False, use_sdpa=False, fused_qkv=False,
+                 **kwargs):
         super(EncoderBlock, self).__init__(**kwargs)
         self.attention = d2l.MultiHeadAttention(
             key_size, query_size, value_size, num_hiddens, num_heads, dropout,
-            use_bias)
+            use_bias, use_sdpa, fused_qkv)
         self.addnorm1 = AddNorm(norm_shape, dropout)
         self.ffn = PositionWiseFFN(
             ffn_num_input, ffn_num_hiddens, num_hiddens)
         self.addnorm2 = AddNorm(norm_shape, dropout)
 
-    def forward(self, X, valid_lens):
-        Y = self.addnorm1(X, self.attention(X, X, X, valid_lens))
+    def forward(self, X, valid_lens, unpadded=None):
+        if unpadded is None:
+            Y = self.addnorm1(X, self.attention(X, X, X, valid_lens))
+        else:
+            # X的形状为(有效词元总数，num_hiddens)，
+            # unpadded为(有效词元的索引，num_steps)
+            Y = self.addnorm1(X, self.attention.unpadded_forward(
+                X, valid_lens, *unpadded))
         return self.addnorm2(Y, self.ffn(Y))
 
 class TransformerEncoder(d2l.Encoder):
@@ -1335,9 +2092,14 @@ class TransformerEncoder(d2l.Encoder):
     Defined in :numref:`sec_transformer`"""
     def __init__(self, vocab_size, key_size, query_size, value_size,
                  num_hiddens, norm_shape, ffn_num_input, ffn_num_hiddens,
-                 num_heads, num_layers, dropout, use_bias=False, **kwargs):
+                 num_heads, num_layers, dropout, use_bias=False,
+                 use_sdpa=False, fused_qkv=False, unpad=False,
+                 checkpoint_every=0, **kwargs):
         super(TransformerEncoder, self).__init__(**kwargs)
         self.num_hiddens = num_hiddens
+        self.unpad = unpad
+        # 大于0时，训练时每checkpoint_every个编码器块作为一段进行激活检查点
+        self.checkpoint_every = checkpoint_every
         self.embedding = nn.Embedding(vocab_size, num_hiddens)
         self.pos_encoding = d2l.PositionalEncoding(num_hiddens, dropout)
         self.blks = nn.Sequential()
@@ -1345,20 +2107,56 @@ class TransformerEncoder(d2l.Encoder):
             self.blks.add_module("block"+str(i),
                 EncoderBlock(key_size, query_size, value_size, num_hiddens,
                              norm_shape, ffn_num_input, ffn_num_hiddens,
-                             num_heads, dropout, use_bias))
+                             num_heads, dropout, use_bias, use_sdpa,
+                             fused_qkv))
 
     def forward(self, X, valid_lens, *args):
         # 因为位置编码值在-1和1之间，
         # 因此嵌入值乘以嵌入维度的平方根进行缩放，
         # 然后再与位置编码相加。
         X = self.pos_encoding(self.embedding(X) * math.sqrt(self.num_hiddens))
-        self.attention_weights = [None] * len(self.blks)
-        for i, blk in enumerate(self.blks):
-            X = blk(X, valid_lens)
-            self.attention_weights[
-                i] = blk.attention.attention.attention_weights
+        batch_size, num_steps = X.shape[:2]
+        unpadded = None
+        if self.unpad and valid_lens is not None and valid_lens.dim() == 1:
+            # 各个编码器块只对有效词元计算，最后再填充回原来的形状
+            unpadded = (d2l._unpad_indices(valid_lens, num_steps), num_steps)
+            X = X.flatten(0, 1)[unpadded[0]]
+        if (self.checkpoint_every > 0 and self.training
+                and torch.is_grad_enabled()):
+            X = d2l._checkpoint_blocks(self.blks, self.checkpoint_every, X,
+                                       valid_lens, unpadded)
+        else:
+            for blk in self.blks:
+                X = blk(X, valid_lens, unpadded)
+        if unpadded is not None:
+            X = d2l._pad_tokens(X, unpadded[0], batch_size, num_steps)
+        return X
+
+    @property
+    def attention_weights(self):
+        # 编码器本身不再保存注意力权重，访问时从各个编码器块中收集
+        return [blk.attention.attention.attention_weights
+                for blk in self.blks]
+
+def _checkpoint_blocks(blks, every, X, *args):
+    """每every个块作为一段进行激活检查点，args是每个块除X之外的输入
+
+    Defined in :numref:`sec_transformer`"""
+    def run(segment, X):
+        for blk in segment:
+            X = blk(X, *args)
+            # 注意力权重会在反向传播之前一直占用内存，因此不保留
+            blk.attention.attention.attention_weights = None
         return X
 
+    blks = list(blks)
+    # 关闭提前停止，使反向传播时的重新计算也会执行完run，从而清除注意力权重
+    with torch.utils.checkpoint.set_checkpoint_early_stop(False):
+        for i in range(0, len(blks), every):
+            X = torch.utils.checkpoint.checkpoint(
+                run, blks[i: i + every], X, use_reentrant=False)
+    return X
+
 def annotate(text, xy, xytext):
     d2l.plt.gca().annotate(text, xy=xy, xytext=xytext,
                            arrowprops=dict(arrowstyle='->'))
@@ -2165,6 +2963,154 @@ def load_data_ptb(batch_size, max_window_size, num_noise_words):
         collate_fn=batchify, num_workers=num_workers)
     return data_iter, vocab
 
+def _reduce_pairs(keys, vals):
+    """合并相同键的共现计数，返回按键排序的结果
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=vals).astype(np.float32)
+
+def _count_pairs(task):
+    """统计一个语料块中按距离加权的词对共现计数
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    seqs, vocab_size, window_size = task
+    keys, vals = [np.zeros(0, dtype=np.int64)], [np.zeros(0, np.float32)]
+    for seq, num_centers in seqs:
+        seq = np.asarray(seq, dtype=np.int64)
+        for d in range(1, window_size + 1):
+            right = seq[d:num_centers + d]
+            if len(right) == 0:
+                break
+            left = seq[:len(right)]
+            # 相距d的两个词的共现计数为1/d，且x_ij=x_ji
+            weights = np.full(len(right), 1 / d, dtype=np.float32)
+            keys += [left * vocab_size + right, right * vocab_size + left]
+            vals += [weights, weights]
+    return _reduce_pairs(np.concatenate(keys), np.concatenate(vals))
+
+def _split_corpus(corpus, window_size, chunk_tokens):
+    """将语料切分为若干块，每块大约包含chunk_tokens个词元
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    if isinstance(corpus, np.ndarray):
+        # 一维词元索引数组（例如np.memmap），词对可以跨越块的边界
+        for i in range(0, len(corpus), chunk_tokens):
+            seq = np.asarray(corpus[i: i + chunk_tokens + window_size])
+            yield [(seq, min(chunk_tokens, len(corpus) - i))]
+    else:
+        # 词元索引列表的列表，词对不跨越句子
+        chunk, num_tokens = [], 0
+        for line in corpus:
+            chunk.append((line, len(line)))
+            num_tokens += len(line)
+            if num_tokens >= chunk_tokens:
+                yield chunk
+                chunk, num_tokens = [], 0
+        if chunk:
+            yield chunk
+
+def _merge_runs(runs, vocab_size, out_dir, max_pairs):
+    """按行块归并有序的溢写文件，写出CSR格式的共现矩阵
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    runs = [(np.load(k, mmap_mode='r'), np.load(v, mmap_mode='r'))
+            for k, v in runs]
+    # run_starts[r][i]是第r个溢写文件中第i行的起始位置，
+    # row_starts[i]是所有溢写文件中前i行的词对总数
+    row_keys = np.arange(vocab_size + 1, dtype=np.int64) * vocab_size
+    run_starts = [k.searchsorted(row_keys) for k, _ in runs]
+    row_starts = sum(run_starts, np.zeros(vocab_size + 1, dtype=np.int64))
+    # 共现矩阵各行的非零元素个数相差悬殊，因此按实际的词对数划分行块：
+    # 每块的词对数不超过max_pairs，除非一行的词对数就已超过max_pairs
+    bounds = [0]
+    while bounds[-1] < vocab_size:
+        end = np.searchsorted(row_starts, row_starts[bounds[-1]] + max_pairs,
+                              side='right') - 1
+        bounds.append(max(int(end), bounds[-1] + 1))
+    row_nnz = np.zeros(vocab_size, dtype=np.int64)
+    with open(os.path.join(out_dir, 'indices.bin'), 'wb') as f_indices, \
+         open(os.path.join(out_dir, 'data.bin'), 'wb') as f_data:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            keys, vals = [np.zeros(0, np.int64)], [np.zeros(0, np.float32)]
+            for (k, v), starts in zip(runs, run_starts):
+                i, j = starts[start], starts[end]
+                keys.append(k[i:j])
+                vals.append(v[i:j])
+            keys, vals = _reduce_pairs(np.concatenate(keys),
+                                       np.concatenate(vals))
+            row_nnz[start:end] = np.bincount(keys // vocab_size - start,
+                                             minlength=end - start)
+            f_indices.write((keys % vocab_size).astype(np.int32).tobytes())
+            f_data.write(vals.tobytes())
+    indptr = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(row_nnz)])
+    np.save(os.path.join(out_dir, 'indptr.npy'), indptr)
+
+def build_cooccurrence(corpus, vocab_size, out_dir, window_size=10,
+                       chunk_tokens=100000, max_pairs=10000000,
+                       num_workers=4):
+    """流式构建GloVe的共现矩阵，并以CSR格式保存到out_dir
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = ((chunk, vocab_size, window_size)
+             for chunk in _split_corpus(corpus, window_size, chunk_tokens))
+    runs, buffer = [], []
+
+    def spill():
+        # 将内存中的计数合并排序后写入磁盘
+        keys, vals = _reduce_pairs(np.concatenate([k for k, _ in buffer]),
+                                   np.concatenate([v for _, v in buffer]))
+        run = [os.path.join(out_dir, f'run{len(runs)}_{name}.npy')
+               for name in ('keys', 'vals')]
+        np.save(run[0], keys)
+        np.save(run[1], vals)
+        runs.append(run)
+        buffer.clear()
+
+    def add(counts):
+        # 主进程累积计数，并在超出max_pairs时溢写
+        buffer.append(counts)
+        if sum(len(k) for k, _ in buffer) >= max_pairs:
+            spill()
+
+    if num_workers > 0:
+        # 各进程分别统计一个语料块。最多有2*num_workers个任务同时在途，
+        # 以免已完成的计数在主进程中堆积得比溢写更快
+        with multiprocessing.Pool(num_workers) as pool:
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(_count_pairs, (task,)))
+                if len(pending) >= 2 * num_workers:
+                    add(pending.popleft().get())
+            while pending:
+                add(pending.popleft().get())
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            add(_count_pairs(task))
+    if buffer:
+        spill()
+    _merge_runs(runs, vocab_size, out_dir, max_pairs)
+    for run in runs:
+        for fname in run:
+            os.remove(fname)
+    return load_cooccurrence(out_dir)
+
+def load_cooccurrence(out_dir):
+    """以内存映射方式加载CSR格式的共现矩阵
+
+    Defined in :numref:`subsec_glove-cooccurrence`"""
+    indptr = np.load(os.path.join(out_dir, 'indptr.npy'), mmap_mode='r')
+    if indptr[-1] == 0:
+        return indptr, np.zeros(0, dtype=np.int32), np.zeros(0, np.float32)
+    indices = np.memmap(os.path.join(out_dir, 'indices.bin'),
+                        dtype=np.int32, mode='r')
+    data = np.memmap(os.path.join(out_dir, 'data.bin'),
+                     dtype=np.float32, mode='r')
+    return indptr, indices, data
+
 d2l.DATA_HUB['glove.6b.50d'] = (d2l.DATA_URL + 'glove.6B.50d.zip',
                                 '0b8703943ccdb6eb788e6f091b8946e82231bc4d')
 
@@ -2179,39 +3125,270 @@ d2l.DATA_HUB['wiki.en'] = (d2l.DATA_URL + 'wiki.en.zip',
 
 class TokenEmbedding:
     """GloVe嵌入"""
-    def __init__(self, embedding_name):
+    def __init__(self, embedding_name, dtype=torch.float32, vocab=None):
         """Defined in :numref:`sec_synonyms`"""
-        self.idx_to_token, self.idx_to_vec = self._load_embedding(
-            embedding_name)
+        if vocab is None:
+            self.idx_to_token, self.idx_to_vec, self.scales = \
+                self._load_embedding(embedding_name, dtype)
+        else:
+            # 只保留词表vocab中的词元，词向量与vocab的索引对齐
+            self.idx_to_token = vocab.idx_to_token
+            self.idx_to_vec, self.scales, self.oov_rate = \
+                self._load_vocab_embedding(embedding_name, dtype, vocab)
         self.unknown_idx = 0
-        self.token_to_idx = {token: idx for idx, token in
-                             enumerate(self.idx_to_token)}
+        self.token_to_idx = dict(zip(self.idx_to_token,
+                                     range(len(self.idx_to_token))))
+        # 由build_index构建的IVF索引
+        self.index = None
 
-    def _load_embedding(self, embedding_name):
-        idx_to_token, idx_to_vec = ['<unk>'], []
+    def _load_embedding(self, embedding_name, dtype):
         data_dir = d2l.download_extract(embedding_name)
+        dtype_name = str(dtype).split('.')[-1]
+        vec_file = os.path.join(data_dir, f'vec.{dtype_name}.npy')
+        scale_file = os.path.join(data_dir, f'vec.{dtype_name}.scale.npy')
+        token_file = os.path.join(data_dir, 'vec.tokens.txt')
+        cache_files = [vec_file, token_file] + (
+            [scale_file] if dtype == torch.int8 else [])
+        if not all(os.path.exists(fname) for fname in cache_files):
+            self._convert_embedding(data_dir, vec_file, scale_file,
+                                    token_file, dtype_name)
+        with open(token_file, 'r') as f:
+            idx_to_token = f.read().split('\n')
+        # 以写时复制的方式映射到内存，多个进程共享同一份物理内存
+        idx_to_vec = torch.from_numpy(np.load(vec_file, mmap_mode='c'))
+        scales = (torch.from_numpy(np.load(scale_file, mmap_mode='c'))
+                  if dtype == torch.int8 else None)
+        return idx_to_token, idx_to_vec, scales
+
+    def _quantize(self, vec, dtype_name):
+        # int8按行对称量化：每行用各自的缩放因子映射到[-127, 127]
+        if dtype_name != 'int8':
+            return vec, 1
+        scale = float(np.abs(vec).max()) / 127
+        return (np.round(vec / scale), scale) if scale > 0 else (vec, 0)
+
+    def _convert_embedding(self, data_dir, vec_file, scale_file, token_file,
+                           dtype_name):
         # GloVe网站：https://nlp.stanford.edu/projects/glove/
         # fastText网站：https://fasttext.cc/
-        with open(os.path.join(data_dir, 'vec.txt'), 'r') as f:
+        txt_file = os.path.join(data_dir, 'vec.txt')
+        # 第一遍扫描统计词元数和向量维度，跳过标题信息，例如fastText中的首行
+        num_tokens, dim = 0, 0
+        with open(txt_file, 'r') as f:
+            for line in f:
+                num_elems = line.rstrip().count(' ')
+                if num_elems > 1:
+                    num_tokens, dim = num_tokens + 1, num_elems
+        # 第二遍扫描将向量直接写入文件，第0行是未知词元的零向量
+        tmp_file = f'{vec_file}.{os.getpid()}.tmp'
+        idx_to_vec = np.lib.format.open_memmap(
+            tmp_file, mode='w+', dtype=dtype_name,
+            shape=(num_tokens + 1, dim))
+        scales = np.zeros((num_tokens + 1, 1), dtype=np.float32)
+        idx_to_token = ['<unk>']
+        with open(txt_file, 'r') as f:
             for line in f:
                 elems = line.rstrip().split(' ')
-                token, elems = elems[0], [float(elem) for elem in elems[1:]]
+                if len(elems) > 2:
+                    i = len(idx_to_token)
+                    idx_to_vec[i], scales[i] = self._quantize(
+                        np.array(elems[1:], dtype=np.float32), dtype_name)
+                    idx_to_token.append(elems[0])
+        idx_to_vec.flush()
+        del idx_to_vec
+        # 先写入临时文件再重命名，避免其他进程读到不完整的缓存
+        if dtype_name == 'int8':
+            np.save(f'{scale_file}.{os.getpid()}.tmp.npy', scales)
+            os.replace(f'{scale_file}.{os.getpid()}.tmp.npy', scale_file)
+        os.replace(tmp_file, vec_file)
+        with open(f'{token_file}.{os.getpid()}.tmp', 'w') as f:
+            f.write('\n'.join(idx_to_token))
+        os.replace(f'{token_file}.{os.getpid()}.tmp', token_file)
+
+    def _load_vocab_embedding(self, embedding_name, dtype, vocab):
+        data_dir = d2l.download_extract(embedding_name)
+        dtype_name = str(dtype).split('.')[-1]
+        idx_to_vec, found = None, torch.zeros(len(vocab), dtype=torch.bool)
+        scales = torch.zeros((len(vocab), 1))
+        with open(os.path.join(data_dir, 'vec.txt'), 'r') as f:
+            for line in f:
+                token, _, elems = line.rstrip().partition(' ')
                 # 跳过标题信息，例如fastText中的首行
-                if len(elems) > 1:
-                    idx_to_token.append(token)
-                    idx_to_vec.append(elems)
-        idx_to_vec = [[0] * len(idx_to_vec[0])] + idx_to_vec
-        return idx_to_token, d2l.tensor(idx_to_vec)
+                if ' ' not in elems:
+                    continue
+                if idx_to_vec is None:
+                    # 不在预训练词表中的词元使用零向量
+                    idx_to_vec = torch.zeros(
+                        (len(vocab), elems.count(' ') + 1), dtype=dtype)
+                # 只解析词表中的词元所在的行
+                idx = vocab.token_to_idx.get(token)
+                if idx is not None:
+                    vec, scales[idx] = self._quantize(
+                        np.array(elems.split(' '), dtype=np.float32),
+                        dtype_name)
+                    idx_to_vec[idx] = torch.from_numpy(vec)
+                    found[idx] = True
+        if idx_to_vec is None:
+            raise ValueError(f'{embedding_name}的vec.txt中没有词向量')
+        # 未知词元和保留词元本来就没有预训练向量，不计入未登录词
+        special = vocab[['<unk>'] + vocab.reserved_tokens]
+        regular = torch.ones(len(vocab), dtype=torch.bool)
+        regular[special] = False
+        return (idx_to_vec, scales if dtype == torch.int8 else None,
+                1 - found[regular].float().mean().item())
 
     def __getitem__(self, tokens):
         indices = [self.token_to_idx.get(token, self.unknown_idx)
                    for token in tokens]
-        vecs = self.idx_to_vec[d2l.tensor(indices)]
+        return self.dequantize(d2l.tensor(indices))
+
+    def dequantize(self, indices=None):
+        """返回indices（默认为全部）对应的float32词向量"""
+        # float16和int8格式的词向量在查找时即时反量化为float32
+        if indices is None:
+            indices = slice(None)
+        vecs = self.idx_to_vec[indices].float()
+        if self.scales is not None:
+            vecs = vecs * self.scales[indices]
         return vecs
 
     def __len__(self):
         return len(self.idx_to_token)
 
+    def build_index(self, path=None, **kwargs):
+        """构建词向量的IVF索引，path处已保存索引时以内存映射的方式加载"""
+        if path is not None and os.path.exists(path):
+            self.index = load_ivf_index(path)
+        else:
+            self.index = build_ivf_index(self.idx_to_vec, **kwargs)
+            if path is not None:
+                self.index.save(path)
+        return self.index
+
+    def search(self, X, k, num_probes=8):
+        """返回与X中每个查询最相似的k个词元的索引和余弦相似度"""
+        # 构建了IVF索引时近似搜索，否则分块精确搜索
+        if self.index is None:
+            return topk_cosine(self.idx_to_vec, X, k)
+        return self.index.search(X, k, num_probes)
+
+def topk_cosine(W, X, k, chunk_size=65536):
+    """分块计算X中每个查询与W中各行的余弦相似度，返回前k个最相似的行
+
+    Defined in :numref:`sec_synonyms`"""
+    X = X.float()
+    X = X / torch.sqrt(torch.sum(X * X, dim=1, keepdim=True) + 1e-9)
+    top_idx = torch.zeros((len(X), 0), dtype=torch.long)
+    top_cos = torch.zeros((len(X), 0))
+    for start in range(0, len(W), chunk_size):
+        # W可以是float16或按行量化的int8矩阵，每次只将一块转换为float32，
+        # 而每行的缩放因子在计算余弦相似度时相互抵消
+        chunk = W[start: start + chunk_size].float()
+        cos = torch.mm(X, chunk.T) / torch.sqrt(
+            torch.sum(chunk * chunk, dim=1) + 1e-9)
+        idx = torch.arange(start, start + len(chunk)).expand(len(X), -1)
+        # 合并当前块与之前各块中保留的前k个结果
+        cos, idx = torch.cat([top_cos, cos], 1), torch.cat([top_idx, idx], 1)
+        top_cos, pos = torch.topk(cos, min(k, cos.shape[1]), dim=1)
+        top_idx = torch.gather(idx, 1, pos)
+    return top_idx, top_cos
+
+class IVFIndex:
+    """倒排文件（IVF）近似最近邻索引"""
+    def __init__(self, centroids, offsets, ids, vecs, inv_norms):
+        """Defined in :numref:`subsec_knn-index`"""
+        # 第l个倒排列表中的行为ids[offsets[l]:offsets[l+1]]，其向量连续地
+        # 存储在vecs[offsets[l]:offsets[l+1]]中。vecs保持词向量原有的存储
+        # 格式（例如float16或int8），inv_norms是每个向量的范数的倒数
+        self.centroids, self.offsets = centroids, offsets
+        self.ids, self.vecs, self.inv_norms = ids, vecs, inv_norms
+        self._bounds = offsets.tolist()
+
+    def search(self, X, k, num_probes=8):
+        """在与查询最相似的num_probes个倒排列表中搜索前k个最相似的行"""
+        X = X.float()
+        X = X / torch.sqrt(torch.sum(X * X, dim=1, keepdim=True) + 1e-9)
+        probes, _ = topk_cosine(self.centroids, X, num_probes)
+        # 第q个查询探查的第j个列表的前k个结果保存在第q*num_probes+j行
+        num_probes = probes.shape[1]
+        cand_idx = torch.full((probes.numel(), k), -1, dtype=torch.long)
+        cand_cos = torch.full((probes.numel(), k), -float('inf'))
+        # 按倒排列表对(查询,列表)对分组，每个被探查的列表只做一次矩阵乘法
+        probes = probes.reshape(-1)
+        order = torch.argsort(probes, stable=True)
+        lists, counts = torch.unique_consecutive(probes[order],
+                                                 return_counts=True)
+        for l, rows in zip(lists.tolist(), order.split(counts.tolist())):
+            s, e = self._bounds[l], self._bounds[l + 1]
+            if s == e:
+                continue
+            # 每次只将一个倒排列表转换为float32
+            cos = (torch.mm(X[rows // num_probes], self.vecs[s:e].float().T)
+                   * self.inv_norms[s:e])
+            cos, pos = torch.topk(cos, min(k, e - s), dim=1)
+            cand_idx[rows, :pos.shape[1]] = self.ids[s:e][pos]
+            cand_cos[rows, :pos.shape[1]] = cos
+        # 合并每个查询在各个列表中的候选结果
+        top_cos, pos = torch.topk(cand_cos.reshape(len(X), -1), k, dim=1)
+        return torch.gather(cand_idx.reshape(len(X), -1), 1, pos), top_cos
+
+    def save(self, path):
+        torch.save({'centroids': self.centroids, 'offsets': self.offsets,
+                    'ids': self.ids, 'vecs': self.vecs,
+                    'inv_norms': self.inv_norms}, path)
+
+def build_ivf_index(W, num_lists=1024, num_iters=10, sample_size=65536,
+                    chunk_size=65536):
+    """用球面k均值训练粗量化器，并将W的每一行分到最近的聚类中心
+
+    Defined in :numref:`subsec_knn-index`"""
+    # 在随机抽取的样本上训练k均值，只有样本被转换为单位化的float32向量
+    sample = W[torch.randperm(len(W))[:max(sample_size, num_lists)]].float()
+    sample = sample / torch.sqrt(
+        torch.sum(sample * sample, dim=1, keepdim=True) + 1e-9)
+    centroids = sample[torch.randperm(len(sample))[:num_lists]].clone()
+    for _ in range(num_iters):
+        assign = topk_cosine(centroids, sample, 1)[0][:, 0]
+        sums = torch.zeros_like(centroids).index_add_(0, assign, sample)
+        # 空的聚类保持原来的中心
+        nonempty = torch.bincount(assign, minlength=len(centroids)) > 0
+        centroids[nonempty] = sums[nonempty] / torch.sqrt(torch.sum(
+            sums[nonempty] ** 2, dim=1, keepdim=True) + 1e-9)
+    # topk_cosine每次只将W的一块转换为float32并单位化
+    assign = torch.cat([topk_cosine(centroids, W[i: i + chunk_size], 1)[0]
+                        for i in range(0, len(W), chunk_size)])[:, 0]
+    ids = torch.argsort(assign, stable=True)
+    offsets = torch.zeros(len(centroids) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.bincount(assign,
+                                              minlength=len(centroids)), 0)
+    # 倒排列表中的向量保持W的存储格式
+    vecs = W[ids]
+    inv_norms = torch.cat([
+        torch.rsqrt(torch.sum(vecs[i: i + chunk_size].float() ** 2, dim=1)
+                    + 1e-9) for i in range(0, len(vecs), chunk_size)])
+    return IVFIndex(centroids, offsets, ids, vecs, inv_norms)
+
+def load_ivf_index(path):
+    """以内存映射的方式加载保存在磁盘上的IVF索引
+
+    Defined in :numref:`subsec_knn-index`"""
+    return IVFIndex(**torch.load(path, mmap=True))
+
+def benchmark_ivf_index(index, W, X, k=10, probes=(1, 4, 16, 64)):
+    """比较IVF索引和精确搜索的召回率与每个查询的平均延迟
+
+    Defined in :numref:`subsec_knn-index`"""
+    timer = d2l.Timer()
+    exact, _ = topk_cosine(W, X, k)
+    print(f'exact: {timer.stop() / len(X) * 1e3:.3f} ms/query')
+    for num_probes in probes:
+        timer.start()
+        approx, _ = index.search(X, k, num_probes)
+        latency = timer.stop() / len(X) * 1e3
+        recall = (approx[:, :, None] == exact[:, None, :]).any(2).float()
+        print(f'num_probes {num_probes}: recall@{k} '
+              f'{float(recall.mean()):.3f}, {latency:.3f} ms/query')
+
 def get_tokens_and_segments(tokens_a, tokens_b=None):
     """获取输入序列的词元及其片段索引
 
@@ -2231,25 +3408,50 @@ class BERTEncoder(nn.Module):
     def __init__(self, vocab_size, num_hiddens, norm_shape, ffn_num_input,
                  ffn_num_hiddens, num_heads, num_layers, dropout,
                  max_len=1000, key_size=768, query_size=768, value_size=768,
-                 **kwargs):
+                 use_sdpa=False, fused_qkv=False, unpad=False,
+                 checkpoint_every=0, **kwargs):
         super(BERTEncoder, self).__init__(**kwargs)
+        self.unpad, self.checkpoint_every = unpad, checkpoint_every
         self.token_embedding = nn.Embedding(vocab_size, num_hiddens)
         self.segment_embedding = nn.Embedding(2, num_hiddens)
         self.blks = nn.Sequential()
         for i in range(num_layers):
             self.blks.add_module(f"{i}", d2l.EncoderBlock(
                 key_size, query_size, value_size, num_hiddens, norm_shape,
-                ffn_num_input, ffn_num_hiddens, num_heads, dropout, True))
+                ffn_num_input, ffn_num_hiddens, num_heads, dropout, True,
+                use_sdpa, fused_qkv))
         # 在BERT中，位置嵌入是可学习的，因此我们创建一个足够长的位置嵌入参数
         self.pos_embedding = nn.Parameter(torch.randn(1, max_len,
                                                       num_hiddens))
 
-    def forward(self, tokens, segments, valid_lens):
+    def forward(self, tokens, segments, valid_lens, positions=None):
         # 在以下代码段中，X的形状保持不变：（批量大小，最大序列长度，num_hiddens）
+        batch_size, num_steps = tokens.shape
+        unpadded = None
+        if self.unpad and valid_lens is not None and valid_lens.dim() == 1:
+            # 只对有效词元计算嵌入和各个编码器块，X的形状为
+            # （有效词元总数，num_hiddens），最后再填充回原来的形状
+            indices = d2l._unpad_indices(valid_lens, num_steps)
+            unpadded = (indices, num_steps)
+            tokens, segments = tokens.flatten()[indices], segments.flatten()[
+                indices]
+            positions = indices % num_steps
         X = self.token_embedding(tokens) + self.segment_embedding(segments)
-        X = X + self.pos_embedding.data[:, :X.shape[1], :]
-        for blk in self.blks:
-            X = blk(X, valid_lens)
+        if positions is None:
+            X = X + self.pos_embedding.data[:, :X.shape[1], :]
+        else:
+            # 打包序列中每个样本的位置从0重新开始计数
+            X = X + self.pos_embedding.data[0][positions]
+        if (self.checkpoint_every > 0 and self.training
+                and torch.is_grad_enabled()):
+            # 每checkpoint_every个编码器块作为一段进行激活检查点
+            X = d2l._checkpoint_blocks(self.blks, self.checkpoint_every, X,
+                                       valid_lens, unpadded)
+        else:
+            for blk in self.blks:
+                X = blk(X, valid_lens, unpadded)
+        if unpadded is not None:
+            X = d2l._pad_tokens(X, indices, batch_size, num_steps)
         return X
 
 class MaskLM(nn.Module):
@@ -2296,33 +3498,44 @@ class BERTModel(nn.Module):
                  ffn_num_hiddens, num_heads, num_layers, dropout,
                  max_len=1000, key_size=768, query_size=768, value_size=768,
                  hid_in_features=768, mlm_in_features=768,
-                 nsp_in_features=768):
+                 nsp_in_features=768, use_sdpa=False, fused_qkv=False,
+                 unpad=False, checkpoint_every=0):
         super(BERTModel, self).__init__()
         self.encoder = BERTEncoder(vocab_size, num_hiddens, norm_shape,
                     ffn_num_input, ffn_num_hiddens, num_heads, num_layers,
                     dropout, max_len=max_len, key_size=key_size,
-                    query_size=query_size, value_size=value_size)
+                    query_size=query_size, value_size=value_size,
+                    use_sdpa=use_sdpa, fused_qkv=fused_qkv, unpad=unpad,
+                    checkpoint_every=checkpoint_every)
         self.hidden = nn.Sequential(nn.Linear(hid_in_features, num_hiddens),
                                     nn.Tanh())
         self.mlm = MaskLM(vocab_size, num_hiddens, mlm_in_features)
         self.nsp = NextSentencePred(nsp_in_features)
 
     def forward(self, tokens, segments, valid_lens=None,
-                pred_positions=None):
-        encoded_X = self.encoder(tokens, segments, valid_lens)
+                pred_positions=None, positions=None, cls_positions=None):
+        encoded_X = self.encoder(tokens, segments, valid_lens, positions)
         if pred_positions is not None:
             mlm_Y_hat = self.mlm(encoded_X, pred_positions)
         else:
             mlm_Y_hat = None
-        # 用于下一句预测的多层感知机分类器的隐藏层，0是“<cls>”标记的索引
-        nsp_Y_hat = self.nsp(self.hidden(encoded_X[:, 0, :]))
+        if cls_positions is None:
+            # 用于下一句预测的多层感知机分类器的隐藏层，0是“<cls>”标记的索引
+            nsp_Y_hat = self.nsp(self.hidden(encoded_X[:, 0, :]))
+        else:
+            # 打包序列的每一行有多个“<cls>”，nsp_Y_hat的形状为
+            # （批量大小，每行的样本数，2）
+            batch_idx = torch.arange(tokens.shape[0],
+                                     device=tokens.device).reshape(-1, 1)
+            nsp_Y_hat = self.nsp(self.hidden(
+                encoded_X[batch_idx, cls_positions]))
         return encoded_X, mlm_Y_hat, nsp_Y_hat
 
 d2l.DATA_HUB['wikitext-2'] = (
     'https://s3.amazonaws.com/research.metamind.io/wikitext/'
     'wikitext-2-v1.zip', '3c914d17d80b1459be871a5039ac23e752a53cbe')
 
-def _read_wiki(data_dir):
+def _read_wiki(data_dir, rng=random):
     """Defined in :numref:`sec_bert-dataset`"""
     file_name = os.path.join(data_dir, 'wiki.train.tokens')
     with open(file_name, 'r') as f:
@@ -2330,7 +3543,7 @@ def _read_wiki(data_dir):
     # 大写字母转换为小写字母
     paragraphs = [line.strip().lower().split(' . ')
                   for line in lines if len(line.split(' . ')) >= 2]
-    random.shuffle(paragraphs)
+    rng.shuffle(paragraphs)
     return paragraphs
 
 def _get_next_sentence(sentence, next_sentence, paragraphs):
@@ -2405,33 +3618,85 @@ def _get_mlm_data_from_tokens(tokens, vocab):
 def _pad_bert_inputs(examples, max_len, vocab):
     """Defined in :numref:`subsec_prepare_mlm_data`"""
     max_num_mlm_preds = round(max_len * 0.15)
-    all_token_ids, all_segments, valid_lens,  = [], [], []
-    all_pred_positions, all_mlm_weights, all_mlm_labels = [], [], []
-    nsp_labels = []
-    for (token_ids, pred_positions, mlm_pred_label_ids, segments,
-         is_next) in examples:
-        all_token_ids.append(torch.tensor(token_ids + [vocab['<pad>']] * (
-            max_len - len(token_ids)), dtype=torch.long))
-        all_segments.append(torch.tensor(segments + [0] * (
-            max_len - len(segments)), dtype=torch.long))
+    num_examples = len(examples)
+    # 预先分配连续的张量，再将每个样本原地写入其中的一行
+    all_token_ids = torch.full((num_examples, max_len), vocab['<pad>'],
+                               dtype=torch.long)
+    all_segments = torch.zeros((num_examples, max_len), dtype=torch.long)
+    valid_lens = torch.zeros(num_examples, dtype=torch.float32)
+    all_pred_positions = torch.zeros((num_examples, max_num_mlm_preds),
+                                     dtype=torch.long)
+    all_mlm_weights = torch.zeros((num_examples, max_num_mlm_preds),
+                                  dtype=torch.float32)
+    all_mlm_labels = torch.zeros((num_examples, max_num_mlm_preds),
+                                 dtype=torch.long)
+    nsp_labels = torch.zeros(num_examples, dtype=torch.long)
+    for i, (token_ids, pred_positions, mlm_pred_label_ids, segments,
+            is_next) in enumerate(examples):
+        all_token_ids[i, :len(token_ids)] = torch.tensor(token_ids)
+        all_segments[i, :len(segments)] = torch.tensor(segments)
         # valid_lens不包括'<pad>'的计数
-        valid_lens.append(torch.tensor(len(token_ids), dtype=torch.float32))
-        all_pred_positions.append(torch.tensor(pred_positions + [0] * (
-            max_num_mlm_preds - len(pred_positions)), dtype=torch.long))
+        valid_lens[i] = len(token_ids)
+        all_pred_positions[i, :len(pred_positions)] = torch.tensor(
+            pred_positions, dtype=torch.long)
         # 填充词元的预测将通过乘以0权重在损失中过滤掉
-        all_mlm_weights.append(
-            torch.tensor([1.0] * len(mlm_pred_label_ids) + [0.0] * (
-                max_num_mlm_preds - len(pred_positions)),
-                dtype=torch.float32))
-        all_mlm_labels.append(torch.tensor(mlm_pred_label_ids + [0] * (
-            max_num_mlm_preds - len(mlm_pred_label_ids)), dtype=torch.long))
-        nsp_labels.append(torch.tensor(is_next, dtype=torch.long))
+        all_mlm_weights[i, :len(mlm_pred_label_ids)] = 1.0
+        all_mlm_labels[i, :len(mlm_pred_label_ids)] = torch.tensor(
+            mlm_pred_label_ids, dtype=torch.long)
+        nsp_labels[i] = is_next
     return (all_token_ids, all_segments, valid_lens, all_pred_positions,
             all_mlm_weights, all_mlm_labels, nsp_labels)
 
+def _pad_bert_pairs(examples, max_len, vocab):
+    """将下一句预测任务的句子对填充为连续的张量，遮蔽在之后动态生成
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    all_token_ids = torch.full((len(examples), max_len), vocab['<pad>'],
+                               dtype=torch.long)
+    all_segments = torch.zeros((len(examples), max_len), dtype=torch.long)
+    valid_lens = torch.zeros(len(examples), dtype=torch.float32)
+    nsp_labels = torch.zeros(len(examples), dtype=torch.long)
+    for i, (tokens, segments, is_next) in enumerate(examples):
+        all_token_ids[i, :len(tokens)] = torch.tensor(vocab[tokens])
+        all_segments[i, :len(segments)] = torch.tensor(segments)
+        valid_lens[i], nsp_labels[i] = len(tokens), is_next
+    return all_token_ids, all_segments, valid_lens, nsp_labels
+
+def _mask_bert_inputs(token_ids, valid_lens, vocab, max_num_mlm_preds):
+    """为一个小批量的词元向量化地生成遮蔽语言模型任务的数据
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    batch_size, max_len = token_ids.shape
+    # 在遮蔽语言模型任务中不会预测特殊词元和填充词元
+    candidates = ((torch.arange(max_len) < valid_lens[:, None])
+                  & (token_ids != vocab['<cls>'])
+                  & (token_ids != vocab['<sep>']))
+    # 给候选位置随机打分，按分数从高到低排序相当于打乱候选位置
+    scores = torch.where(candidates, torch.rand(batch_size, max_len), -1.0)
+    order = torch.argsort(scores, dim=1, descending=True)
+    order = order[:, :max_num_mlm_preds]
+    # 遮蔽语言模型任务中预测15%的随机词元
+    num_mlm_preds = torch.clamp(torch.round(valid_lens * 0.15), min=1)
+    keep = ((torch.arange(order.shape[1]) < num_mlm_preds[:, None])
+            & torch.gather(candidates, 1, order))
+    # 预测位置按升序排列，填充的预测位置为0，其权重为0
+    pred_positions, _ = torch.sort(torch.where(keep, order, max_len), dim=1)
+    valid = pred_positions < max_len
+    pred_positions = pred_positions * valid
+    mlm_labels = torch.gather(token_ids, 1, pred_positions) * valid
+    # 80%的时间：替换为“<mask>”词元；10%的时间：替换为随机词元；
+    # 10%的时间：保持词元不变
+    p = torch.rand(pred_positions.shape)
+    masked_tokens = torch.where(p < 0.8, vocab['<mask>'], torch.where(
+        p < 0.9, torch.randint(len(vocab), p.shape), mlm_labels))
+    mlm_token_ids = token_ids.clone()
+    mlm_token_ids.scatter_(1, pred_positions, torch.where(
+        valid, masked_tokens, torch.gather(token_ids, 1, pred_positions)))
+    return mlm_token_ids, pred_positions, valid.float(), mlm_labels
+
 class _WikiTextDataset(torch.utils.data.Dataset):
     """Defined in :numref:`subsec_prepare_mlm_data`"""
-    def __init__(self, paragraphs, max_len):
+    def __init__(self, paragraphs, max_len, dynamic_mask=False):
         # 输入paragraphs[i]是代表段落的句子字符串列表；
         # 而输出paragraphs[i]是代表段落的句子列表，其中每个句子都是词元列表
         paragraphs = [d2l.tokenize(
@@ -2445,6 +3710,13 @@ class _WikiTextDataset(torch.utils.data.Dataset):
         for paragraph in paragraphs:
             examples.extend(_get_nsp_data_from_paragraph(
                 paragraph, paragraphs, self.vocab, max_len))
+        self.dynamic_mask = dynamic_mask
+        if dynamic_mask:
+            # 只保存句子对，每次读取小批量时重新生成遮蔽语言模型任务的数据
+            self.max_num_mlm_preds = round(max_len * 0.15)
+            (self.all_token_ids, self.all_segments, self.valid_lens,
+             self.nsp_labels) = _pad_bert_pairs(examples, max_len, self.vocab)
+            return
         # 获取遮蔽语言模型任务的数据
         examples = [(_get_mlm_data_from_tokens(tokens, self.vocab)
                       + (segments, is_next))
@@ -2456,6 +3728,9 @@ class _WikiTextDataset(torch.utils.data.Dataset):
             examples, max_len, self.vocab)
 
     def __getitem__(self, idx):
+        if self.dynamic_mask:
+            return (self.all_token_ids[idx], self.all_segments[idx],
+                    self.valid_lens[idx], self.nsp_labels[idx])
         return (self.all_token_ids[idx], self.all_segments[idx],
                 self.valid_lens[idx], self.all_pred_positions[idx],
                 self.all_mlm_weights[idx], self.all_mlm_labels[idx],
@@ -2464,16 +3739,245 @@ class _WikiTextDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.all_token_ids)
 
-def load_data_wiki(batch_size, max_len):
+    def collate(self, batch):
+        """动态遮蔽模式下将样本组合为小批量，并为其生成新的遮蔽"""
+        token_ids, segments, valid_lens, nsp_labels = \
+            torch.utils.data.default_collate(batch)
+        mlm_token_ids, pred_positions, mlm_weights, mlm_labels = \
+            _mask_bert_inputs(token_ids, valid_lens, self.vocab,
+                              self.max_num_mlm_preds)
+        return (mlm_token_ids, segments, valid_lens, pred_positions,
+                mlm_weights, mlm_labels, nsp_labels)
+
+class _WikiShardDataset(_WikiTextDataset):
+    """由磁盘上的多个分片组成的WikiText-2预训练数据集
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    def __init__(self, shards, vocab, max_len, dynamic_mask):
+        self.shards, self.vocab = shards, vocab
+        self.dynamic_mask = dynamic_mask
+        self.max_num_mlm_preds = round(max_len * 0.15)
+        # offsets[i]是前i个分片的样本总数
+        self.offsets = [0]
+        for shard in shards:
+            self.offsets.append(self.offsets[-1] + len(shard[0]))
+
+    def __getitem__(self, idx):
+        i = bisect.bisect_right(self.offsets, idx) - 1
+        return tuple(t[idx - self.offsets[i]] for t in self.shards[i])
+
+    def __len__(self):
+        return self.offsets[-1]
+
+def _build_wiki_shard(args):
+    """在子进程中为一个分片的段落生成预训练样本，并保存到磁盘
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    paragraphs, vocab, max_len, dynamic_mask, seed, fname = args
+    # 每个分片使用自己的随机种子，下一句预测的随机句子也从本分片中抽取
+    random.seed(seed)
+    examples = []
+    for paragraph in paragraphs:
+        examples.extend(_get_nsp_data_from_paragraph(
+            paragraph, paragraphs, vocab, max_len))
+    if dynamic_mask:
+        tensors = _pad_bert_pairs(examples, max_len, vocab)
+    else:
+        examples = [(_get_mlm_data_from_tokens(tokens, vocab)
+                     + (segments, is_next))
+                    for tokens, segments, is_next in examples]
+        tensors = _pad_bert_inputs(examples, max_len, vocab)
+    # 先写入临时文件再重命名，避免其他进程读到不完整的分片
+    torch.save(tensors, f'{fname}.{os.getpid()}.tmp')
+    os.replace(f'{fname}.{os.getpid()}.tmp', fname)
+
+def _load_wiki_shards(data_dir, max_len, dynamic_mask, num_shards, seed=0):
+    """多进程分片地生成WikiText-2的预训练样本，并缓存在磁盘上
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    min_freq, reserved_tokens = 5, ['<pad>', '<mask>', '<cls>', '<sep>']
+    # 分片由原始语料、max_len、词表的参数、遮蔽方式、分片数和随机种子
+    # 共同决定，其中任何一个改变时都重新生成
+    with open(os.path.join(data_dir, 'wiki.train.tokens'), 'rb') as f:
+        corpus_hash = hashlib.sha1(f.read()).hexdigest()[:10]
+    vocab_hash = hashlib.sha1(repr(
+        (min_freq, reserved_tokens)).encode('utf-8')).hexdigest()[:10]
+    shard_dir = os.path.join(
+        data_dir, 'shards', f'{corpus_hash}-{max_len}-{vocab_hash}-'
+        f'{"dynamic" if dynamic_mask else "static"}-{num_shards}-{seed}')
+    fnames = [os.path.join(shard_dir, f'shard{i}.pt')
+              for i in range(num_shards)]
+    vocab_file = os.path.join(shard_dir, 'vocab.txt')
+    freq_file = os.path.join(shard_dir, 'token_freqs.txt')
+    if os.path.exists(vocab_file) and all(map(os.path.exists, fnames)):
+        # 命中缓存时无须词元化，由保存的词频重建词表：按保存的顺序重复
+        # 每个词元，使重建的词表的词频和词元顺序都与原来的相同
+        with open(freq_file, 'r', encoding='utf-8') as f:
+            token_freqs = [line.rsplit('\t', 1)
+                           for line in f.read().split('\n')]
+        vocab = d2l.Vocab([[token] * int(freq) for token, freq in token_freqs],
+                          min_freq=min_freq, reserved_tokens=reserved_tokens)
+    else:
+        paragraphs = _read_wiki(data_dir, random.Random(seed))
+        paragraphs = [d2l.tokenize(
+            paragraph, token='word') for paragraph in paragraphs]
+        sentences = [sentence for paragraph in paragraphs
+                     for sentence in paragraph]
+        vocab = d2l.Vocab(sentences, min_freq=min_freq,
+                          reserved_tokens=reserved_tokens)
+        os.makedirs(shard_dir, exist_ok=True)
+        tasks = [(paragraphs[i::num_shards], vocab, max_len, dynamic_mask,
+                  seed + i, fname) for i, fname in enumerate(fnames)
+                 if not os.path.exists(fname)]
+        if tasks:
+            with multiprocessing.Pool(min(len(tasks),
+                                          os.cpu_count())) as pool:
+                pool.map(_build_wiki_shard, tasks)
+        with open(f'{freq_file}.{os.getpid()}.tmp', 'w',
+                  encoding='utf-8') as f:
+            f.write('\n'.join(f'{token}\t{freq}'
+                              for token, freq in vocab.token_freqs))
+        os.replace(f'{freq_file}.{os.getpid()}.tmp', freq_file)
+        # 最后写入词表，因此它存在时所有的分片和词频都已生成
+        with open(f'{vocab_file}.{os.getpid()}.tmp', 'w',
+                  encoding='utf-8') as f:
+            f.write('\n'.join(vocab.idx_to_token))
+        os.replace(f'{vocab_file}.{os.getpid()}.tmp', vocab_file)
+    # 将分片映射到内存，而不是读入内存
+    shards = [torch.load(fname, mmap=True) for fname in fnames]
+    return _WikiShardDataset(shards, vocab, max_len, dynamic_mask)
+
+def _pack_bert_inputs(tensors, max_len, vocab):
+    """将多个预训练样本装箱到同一行，以减少填充词元
+
+    tensors是_pad_bert_inputs或_pad_bert_pairs的输出，返回的张量中
+    valid_lens被替换为每个词元所属样本在行内的编号（填充词元为-1），
+    下一句预测的标签形状为（行数，每行最多的样本数），填充的标签为-100
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    tensors = [t.numpy() for t in tensors]
+    all_token_ids, all_segments, valid_lens = tensors[:3]
+    nsp_labels = tensors[-1]
+    lens = valid_lens.astype('int64').tolist()
+    # 最佳适应递减装箱：按长度从长到短，将每个样本放入剩余空间最小且放得下的
+    # 一行中，rows_by_space[c]是剩余空间为c的行的编号
+    rows, rows_by_space = [], [[] for _ in range(max_len + 1)]
+    for i in sorted(range(len(lens)), key=lens.__getitem__, reverse=True):
+        space = next((c for c in range(lens[i], max_len + 1)
+                      if rows_by_space[c]), None)
+        if space is None:
+            rows.append([])
+            r, space = len(rows) - 1, max_len
+        else:
+            r = rows_by_space[space].pop()
+        rows[r].append(i)
+        rows_by_space[space - lens[i]].append(r)
+    num_rows = len(rows)
+    max_num_seqs = max(len(row) for row in rows)
+    packed_token_ids = np.full((num_rows, max_len), vocab['<pad>'],
+                               dtype='int64')
+    packed_segments = np.zeros((num_rows, max_len), dtype='int64')
+    seq_ids = np.full((num_rows, max_len), -1, dtype='int64')
+    packed_nsp_labels = np.full((num_rows, max_num_seqs), -100,
+                                dtype='int64')
+    if len(tensors) == 7:
+        all_pred_positions, all_mlm_weights, all_mlm_labels = tensors[3:6]
+        num_preds = all_mlm_weights.sum(axis=1).astype('int64').tolist()
+        max_num_preds = max(sum(num_preds[i] for i in row) for row in rows)
+        pred_positions = np.zeros((num_rows, max_num_preds), dtype='int64')
+        mlm_weights = np.zeros((num_rows, max_num_preds), dtype='float32')
+        mlm_labels = np.zeros((num_rows, max_num_preds), dtype='int64')
+    for r, row in enumerate(rows):
+        offset, num = 0, 0
+        for j, i in enumerate(row):
+            n = lens[i]
+            packed_token_ids[r, offset:offset + n] = all_token_ids[i, :n]
+            packed_segments[r, offset:offset + n] = all_segments[i, :n]
+            seq_ids[r, offset:offset + n] = j
+            packed_nsp_labels[r, j] = nsp_labels[i]
+            if len(tensors) == 7:
+                # 预测位置需要加上样本在行内的偏移量
+                m = num_preds[i]
+                pred_positions[r, num:num + m] = (
+                    all_pred_positions[i, :m] + offset)
+                mlm_weights[r, num:num + m] = 1.0
+                mlm_labels[r, num:num + m] = all_mlm_labels[i, :m]
+                num += m
+            offset += n
+    packed = [packed_token_ids, packed_segments, seq_ids]
+    if len(tensors) == 7:
+        packed += [pred_positions, mlm_weights, mlm_labels]
+    return [torch.from_numpy(t) for t in packed + [packed_nsp_labels]]
+
+def _unpack_seq_ids(seq_ids, max_num_seqs):
+    """由打包序列中每个词元所属样本的编号，计算块对角注意力掩码、
+    每个词元在其样本中的位置和每个样本的“<cls>”的位置
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    num_rows, max_len = seq_ids.shape
+    valid = seq_ids >= 0
+    # 块对角注意力掩码：每个词元只关注同一个样本中的非填充词元
+    mask = (seq_ids[:, :, None] == seq_ids[:, None, :]) & valid[:, None, :]
+    # 第j个样本的“<cls>”位于行内编号小于j的所有非填充词元之后
+    js = torch.arange(max_num_seqs, device=seq_ids.device)
+    cls_positions = (valid[:, None, :]
+                     & (seq_ids[:, None, :] < js[:, None])).sum(dim=2)
+    positions = (torch.arange(max_len, device=seq_ids.device)
+                 - torch.gather(cls_positions, 1, seq_ids.clamp(min=0)))
+    # 填充的样本的“<cls>”位置可能越界，其下一句预测的标签会在损失中被忽略
+    return (mask, positions * valid,
+            cls_positions.clamp(max=max_len - 1))
+
+class _PackedWikiTextDataset(torch.utils.data.Dataset):
+    """将多个预训练样本打包到同一行的WikiText-2预训练数据集
+
+    Defined in :numref:`subsec_prepare_mlm_data`"""
+    def __init__(self, dataset, max_len):
+        self.vocab, self.dynamic_mask = dataset.vocab, dataset.dynamic_mask
+        self.max_num_mlm_preds = round(max_len * 0.15)
+        tensors = torch.utils.data.default_collate(
+            [dataset[i] for i in range(len(dataset))])
+        self.tensors = _pack_bert_inputs(tensors, max_len, self.vocab)
+        # 打包前后非填充词元所占的比例
+        num_tokens = float(tensors[2].sum())
+        self.padding_efficiency = num_tokens / (len(dataset) * max_len)
+        self.packing_efficiency = num_tokens / (len(self) * max_len)
+
+    def __getitem__(self, idx):
+        return tuple(t[idx] for t in self.tensors)
+
+    def __len__(self):
+        return len(self.tensors[0])
+
+    def collate(self, batch):
+        """动态遮蔽模式下将打包的样本组合为小批量，并为其生成新的遮蔽"""
+        token_ids, segments, seq_ids, nsp_labels = \
+            torch.utils.data.default_collate(batch)
+        valid_lens = (seq_ids >= 0).sum(dim=1).float()
+        mlm_token_ids, pred_positions, mlm_weights, mlm_labels = \
+            _mask_bert_inputs(token_ids, valid_lens, self.vocab,
+                              self.max_num_mlm_preds)
+        return (mlm_token_ids, segments, seq_ids, pred_positions,
+                mlm_weights, mlm_labels, nsp_labels)
+
+def load_data_wiki(batch_size, max_len, dynamic_mask=False, num_shards=0,
+                   pack=False):
     """加载WikiText-2数据集
 
     Defined in :numref:`subsec_prepare_mlm_data`"""
     num_workers = d2l.get_dataloader_workers()
     data_dir = d2l.download_extract('wikitext-2', 'wikitext-2')
-    paragraphs = _read_wiki(data_dir)
-    train_set = _WikiTextDataset(paragraphs, max_len)
-    train_iter = torch.utils.data.DataLoader(train_set, batch_size,
-                                        shuffle=True, num_workers=num_workers)
+    if num_shards > 0:
+        train_set = _load_wiki_shards(data_dir, max_len, dynamic_mask,
+                                      num_shards)
+    else:
+        paragraphs = _read_wiki(data_dir)
+        train_set = _WikiTextDataset(paragraphs, max_len, dynamic_mask)
+    if pack:
+        train_set = _PackedWikiTextDataset(train_set, max_len)
+    train_iter = torch.utils.data.DataLoader(
+        train_set, batch_size, shuffle=True, num_workers=num_workers,
+        collate_fn=train_set.collate if dynamic_mask else None)
     return train_iter, train_set.vocab
 
 def _get_batch_loss_bert(net, loss, vocab_size, tokens_X,
@@ -2481,17 +3985,38 @@ def _get_batch_loss_bert(net, loss, vocab_size, tokens_X,
                          pred_positions_X, mlm_weights_X,
                          mlm_Y, nsp_y):
     """Defined in :numref:`sec_bert-pretraining`"""
-    # 前向传播
-    _, mlm_Y_hat, nsp_Y_hat = net(tokens_X, segments_X,
-                                  valid_lens_x.reshape(-1),
-                                  pred_positions_X)
-    # 计算遮蔽语言模型损失
-    mlm_l = loss(mlm_Y_hat.reshape(-1, vocab_size), mlm_Y.reshape(-1)) *\
-    mlm_weights_X.reshape(-1, 1)
-    mlm_l = mlm_l.sum() / (mlm_weights_X.sum() + 1e-8)
+    # 前向传播，近似softmax输出层（见 :numref:`sec_rnn-concise`）返回其输入
+    with d2l.approx_softmax(net) as head:
+        if valid_lens_x.dim() == 2:
+            # 打包的小批量：valid_lens_x是每个词元所属样本在行内的编号
+            mask, positions, cls_positions = d2l._unpack_seq_ids(
+                valid_lens_x, nsp_y.shape[1])
+            _, mlm_Y_hat, nsp_Y_hat = net(tokens_X, segments_X, mask,
+                                          pred_positions_X, positions,
+                                          cls_positions)
+            nsp_Y_hat, nsp_y = nsp_Y_hat.reshape(-1, 2), nsp_y.reshape(-1)
+        else:
+            _, mlm_Y_hat, nsp_Y_hat = net(tokens_X, segments_X,
+                                          valid_lens_x.reshape(-1),
+                                          pred_positions_X)
+    # 计算遮蔽语言模型损失：两种输出层都先计算每个预测位置的损失，
+    # 再按mlm_weights_X加权平均，填充的预测位置的权重为0
+    mlm_weights = mlm_weights_X.reshape(-1)
+    if head is None:
+        mlm_l = nn.functional.cross_entropy(
+            mlm_Y_hat.reshape(-1, vocab_size), mlm_Y.reshape(-1),
+            reduction='none')
+    else:
+        mlm_l = head.loss(mlm_Y_hat, mlm_Y)
+    mlm_l = (mlm_l * mlm_weights).sum() / (mlm_weights.sum() + 1e-8)
     # 计算下一句子预测任务的损失
     nsp_l = loss(nsp_Y_hat, nsp_y)
     l = mlm_l + nsp_l
+    if hasattr(head, 'exact_loss'):
+        # 采样softmax的损失只用于训练，返回整个词表上精确的遮蔽语言模型损失
+        with torch.no_grad():
+            mlm_l = (head.exact_loss(mlm_Y_hat, mlm_Y) * mlm_weights).sum() / (
+                mlm_weights.sum() + 1e-8)
     return mlm_l, nsp_l, l
 
 d2l.DATA_HUB['aclImdb'] = (